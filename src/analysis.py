@@ -12,14 +12,17 @@
 """
 
 import numpy as np
+import time
 import warnings
+from collections import OrderedDict, namedtuple
+import os
 from os import listdir
-import gdax
+import kernels
+import quadrature
+from instrument import NULL_TRACE
 
 warnings.simplefilter('ignore')
 
-global T, ndat
-
 def load():
 	# Load the data
 	print("\nAvailable data files for analysis: ")
@@ -34,15 +37,22 @@ def load():
 	except:
 		print("Unable to interpret choice. Please provide the number of your choice.")
 
-	name = data_files[choice]
+	return load_file('call_data/' + data_files[choice])
+
+def load_file(path):
+	""" Read one call_data file named COIN_DATE_MATURITY.csv.
+		Returns S_0_dat, K_dat, V_dat, T, coin. Files with the maturity of
+		each call in a fifth column (COIN_DATE_multi.csv) give T as an array.
+	"""
+	name = os.path.splitext(os.path.basename(path))[0]
 	try:
 		T = int(name.split("_")[2])
 	except Exception:
 		T = 90
-	path = 'call_data/' + name
 	S_0_dat = []
 	K_dat = []
 	V_dat = []
+	T_dat = []
 	with open(path, 'r') as f:
 		calls = f.readlines()
 		for call in calls:
@@ -50,9 +60,29 @@ def load():
 			S_0_dat.append(float(point[1]))
 			K_dat.append(float(point[2]))
 			V_dat.append(float(point[3]))
+			if len(point) > 4:
+				T_dat.append(int(point[4]))
+	if T_dat:
+		T = np.array(T_dat)
 	coin = name.split("_")[0]
 	return S_0_dat, K_dat, V_dat, T, coin
 
+def load_files(paths):
+	""" Read several call_data files of one coin as a single dataset, for
+		calibrating a term structure. T is the maturity of each call.
+	"""
+	S_0_dat, K_dat, V_dat, T_dat, coins = [], [], [], [], set()
+	for path in paths:
+		S_0, K, V, T, coin = load_file(path)
+		S_0_dat += S_0
+		K_dat += K
+		V_dat += V
+		T_dat.append(np.broadcast_to(T, len(K)))
+		coins.add(coin)
+	if len(coins) > 1:
+		raise ValueError("Cannot calibrate %s together: the files are of different coins." % ", ".join(sorted(coins)))
+	return S_0_dat, K_dat, V_dat, np.concatenate(T_dat), coins.pop()
+
 ############################################################################
 
 """ These are the functions that will help us optimize to our data.
@@ -67,31 +97,102 @@ def P_c1(theta, u, K, t, S_0):
 def P_c2(theta, u, K, t, S_0):
 	return np.real(np.exp(-1j*u*np.log(K))/(1j*u)*phi(theta, u, t, S_0))
 
-def C(theta, S_0, K, t): # The predicted value
-	N = 10
-	tot = 0
-	for k in range(N):
-		i = k + 1
-		# Numeric integration
-		if k == 0:
-			k = 0.1
-		fk_1 = 1/np.pi*(P_c1(theta, k, K, t, S_0) - K*P_c2(theta, k, K, t, S_0))
-		fk = 1/np.pi*(P_c1(theta, i, K, t, S_0) - K*P_c2(theta, i, K, t, S_0))
-		dk = (i - k)/N
-		tot += (fk_1 + fk)/2*dk
-	return (S_0 - K)/2 + tot
+def grid(S_0, K, t):
+	# Broadcast the observations against each other as float arrays
+	return np.broadcast_arrays(*(np.atleast_1d(np.asarray(x, dtype=float)) for x in (S_0, K, t)))
+
+def maturities(t):
+	# The distinct maturities of a (column of) t, and the index of each row's
+	return np.unique(np.ravel(t), return_inverse=True)
+
+class CFCache:
+	""" A bounded LRU memo of the characteristic function terms returned by
+		cf_terms(), keyed on (theta, u, t). Passing the same cache to r(),
+		jac() and C_vec() lets them reuse each other's evaluations.
+		hits and misses count lookups over the life of the cache.
+	"""
+
+	def __init__(self, maxsize=16):
+		self.maxsize = maxsize
+		self.hits = 0
+		self.misses = 0
+		self._entries = OrderedDict()
+
+	def get(self, theta, u, t):
+		key = tuple(np.ascontiguousarray(x, dtype=float).tobytes() for x in (theta, u, t))
+		try:
+			terms = self._entries[key]
+			self._entries.move_to_end(key)
+			self.hits += 1
+			return terms
+		except KeyError:
+			self.misses += 1
+		terms = cf_terms(theta, u, t)
+		self._entries[key] = terms
+		if len(self._entries) > self.maxsize:
+			self._entries.popitem(last=False)
+		return terms
+
+	def clear(self):
+		self._entries.clear()
+
+	def stats(self):
+		total = self.hits + self.misses
+		return {"hits": self.hits, "misses": self.misses, "size": len(self._entries),
+			"maxsize": self.maxsize, "hit_rate": self.hits/total if total else 0.0}
+
+def cf_terms(theta, u, t, cache=None):
+	""" params() and phi() with S_0 = 1 at u - i and at u, for a column of
+		distinct maturities t. These are all the complex terms C_vec() and
+		jac() need, so they share them through cache. phi only depends on
+		S_0 through the factor exp(iu log S_0), so the sinh, cosh and exp
+		terms are evaluated once per maturity rather than once per call.
+	"""
+	if cache is not None:
+		return cache.get(theta, u, t)
+	p_1 = params(theta, u - 1j, t)
+	p_2 = params(theta, u, t)
+	return p_1, p_2, phi(theta, u - 1j, t, 1.0, p_1), phi(theta, u, t, 1.0, p_2)
+
+def integrand(theta, u, K, t, S_0, cache=None, kernel=None):
+	# The pricing integrand, evaluated on every combination of u and (S_0, K, t).
+	# phi at u - i is S_0 exp(iu log S_0) times its value at S_0 = 1.
+	# The per-observation work is done by the kernels backend kernel.
+	S_0, K, t = grid(S_0, K, t)
+	taus, idx = maturities(t)
+	p_1, p_2, phi_1, phi_2 = cf_terms(theta, u, taus[:, None], cache)
+	S_0, K = S_0.ravel(), K.ravel()
+	return kernels.backend(kernel).integrand(u, np.log(S_0/K), S_0, K, idx, phi_1, phi_2)
+
+def C_vec(theta, S_0, K, t, cache=None, quad=None, full_output=False, kernel=None):
+	""" The predicted value of every observation at once. S_0, K and t are
+		arrays (or scalars) that broadcast against each other, so t may
+		hold a different maturity for each call. The characteristic function
+		is evaluated once on a (maturities x nodes) grid.
+		quad is the Quadrature to integrate with (the original ten step rule
+		by default). With full_output, the error estimate of each price and
+		the number of integrand nodes used are returned as well. kernel is
+		the kernels backend (NumPy by default).
+	"""
+	if quad is None:
+		quad = quadrature.Quadrature()
+	kernel = kernels.backend(kernel)
+	S_0, K, t = grid(S_0, K, t)
+	evals = quad.evals
+	tot, err = quad.integrate(lambda u: integrand(theta, u, K[:, None], t[:, None], S_0[:, None], cache, kernel), full_output)
+	price = (S_0 - K)/2 + tot
+	if full_output:
+		return price, err, quad.evals - evals
+	return price
+
+def C(theta, S_0, K, t, quad=None, kernel=None): # The predicted value
+	return C_vec(theta, S_0, K, t, quad=quad, kernel=kernel)[0]
 
 # The residues we wish to minimize
-def r(theta, S_0_dat, K_dat, V_dat, T):
-	residues = np.array(np.zeros(ndat))
-	for i in range(ndat):
-		S_0 = S_0_dat[i]
-		K = K_dat[i]
-		v = V_dat[i]
-		if v <= 0:
-			v = 0
-		residues[i] =  C(theta, S_0, K, T) - v
-	return residues.reshape(ndat, 1)
+def r(theta, S_0_dat, K_dat, V_dat, T, cache=None, quad=None, kernel=None):
+	V = np.maximum(np.asarray(V_dat, dtype=float), 0)
+	residues = C_vec(theta, S_0_dat, K_dat, T, cache, quad, kernel=kernel) - V
+	return residues.reshape(len(V), 1)
 
 def params(theta, u, t):
 	# The parameters we wish to optimize
@@ -109,34 +210,45 @@ def params(theta, u, t):
 	# Larger parameters
 	A_1 = (u**2 + 1j*u)*np.sinh(d*t/2)
 	A_2 = d*np.cosh(d*t/2) + ksi*np.sinh(d*t/2)
-	A = A_1/A_2
+	# A_1/A_2, written with tanh so it stays finite when sinh overflows
+	A = (u**2 + 1j*u)*np.tanh(d*t/2)/(d + ksi*np.tanh(d*t/2))
 	B = d*np.exp(k*t/2)/A_2
 	D = np.log(d) + (k - d)*t/2 - np.log( (d+ksi)/2 + (d-ksi)/2*np.exp(-d*t))
 	return v, v_bar, rho, k, sigma, ksi, d, g, A_1, A_2, A, B, D
 
 
 # The characteristic function
-def phi(theta, u, t, S_0):
-	v, v_bar, rho, k , sigma, ksi, d, g, A_1, A_2, A, B, D = params(theta, u, t)
+def phi(theta, u, t, S_0, p=None):
+	# p may be given to reuse the output of params(theta, u, t)
+	if p is None:
+		p = params(theta, u, t)
+	v, v_bar, rho, k , sigma, ksi, d, g, A_1, A_2, A, B, D = p
 	return np.exp(1j*u*(np.log(S_0)) - t*k*v_bar*rho*1j*u/sigma - v*A + 2*k*v_bar/(sigma**2)*D)
 
 
 # The gradient of the characteristic function. Inedependent of phi.
-def h(theta, K, t, u):
-	v, v_bar, rho, k , sigma, ksi, d, g, A_1, A_2, A, B, D = params(theta, u, t)
-
+def h(theta, K, t, u, p=None):
+	if p is None:
+		p = params(theta, u, t)
+	v, v_bar, rho, k , sigma, ksi, d, g, A_1, A_2, A, B, D = p
+
+	# A_1, A_2 and their derivatives are all divided by cosh(d t/2), so
+	# sinh and cosh appear only through tanh and stay finite (as in A).
+	tanh = np.tanh(d*t/2)
+	a_1 = (u**2 + 1j*u)*tanh
+	a_2 = d + ksi*tanh
 	dddrho = -ksi*sigma*1j*u/d
-	dA_2drho = -sigma*1j*u*(2 + t*ksi)*(ksi*np.cosh(d*t/2)/(2*d) + d*np.sinh(d*t/2))
-	dA_1drho = -1j*u*(u**2 + 1j*u)*t*ksi*sigma*np.cosh(d*t/2)/(2*d)
-	dAdrho = 1/A_2*dA_1drho - A/A_2*dA_2drho
-	dBdrho = np.exp(k*t/2)*(1/A_2*dddrho - d/(A_2**2)*dA_2drho)
-	dBdk = 1j/(sigma*u)*dBdrho + t*B/2
+	da_2drho = -sigma*1j*u*(2 + t*ksi)/(2*d)*(ksi + d*tanh)
+	da_1drho = -1j*u*(u**2 + 1j*u)*t*ksi*sigma/(2*d)
+	dAdrho = (da_1drho - A*da_2drho)/a_2
+	# B only appears as dB/dk / B, and dB/drho / B = dd/drho / d - dA_2/drho / A_2
+	dBdk_B = 1j/(sigma*u)*(dddrho/d - da_2drho/a_2) + t/2
 	dddsigma = (rho/sigma - 1/ksi)*dddrho + sigma*u**2/d
-	dA_1dsigma = (u**2 + 1j*u)*t/2*dddsigma*np.cosh(d*t/2)
-	dA_2dsigma = rho/sigma*dA_2drho - (2+t*ksi)/(1j*u*t*ksi)*dA_1drho + sigma*t*A_1/2
-	dAdsigma = 1/A_2*dA_1dsigma - A/A_2*dA_2dsigma
+	da_1dsigma = (u**2 + 1j*u)*t/2*dddsigma
+	da_2dsigma = rho/sigma*da_2drho - (2+t*ksi)/(1j*u*t*ksi)*da_1drho + sigma*t*a_1/2
+	dAdsigma = (da_1dsigma - A*da_2dsigma)/a_2
 	# Returns a 5 element gradient for each parameter
-	return np.array([-A, 2*k/(sigma**2)*D - t*k*rho*1j*u/sigma, -v*dAdrho + 2*k*v_bar/(sigma**2*d)*(dddrho - d/A_2*dA_2drho) - t*k*v_bar*1j*u/sigma, v/(sigma*1j*u)*dAdrho + 2*v_bar/(sigma**2)*D + 2*k*v_bar/(sigma**2*B)*dBdk - t*v_bar*rho*1j*u/sigma, -v*dAdsigma - 4*k*v_bar/(sigma**3)*D + 2*k*v_bar/(sigma**2*d)*(dddsigma - d/A_2*dA_2dsigma) + t*k*v_bar*rho*1j*u/(sigma**2)])
+	return np.array(np.broadcast_arrays(-A, 2*k/(sigma**2)*D - t*k*rho*1j*u/sigma, -v*dAdrho + 2*k*v_bar/(sigma**2*d)*(dddrho - d/a_2*da_2drho) - t*k*v_bar*1j*u/sigma, v/(sigma*1j*u)*dAdrho + 2*v_bar/(sigma**2)*D + 2*k*v_bar/(sigma**2)*dBdk_B - t*v_bar*rho*1j*u/sigma, -v*dAdsigma - 4*k*v_bar/(sigma**3)*D + 2*k*v_bar/(sigma**2*d)*(dddsigma - d/a_2*da_2dsigma) + t*k*v_bar*rho*1j*u/(sigma**2)))
 
 # Helps us evaluate the jacobian
 def P1(theta, u, K, t, S_0, h_j):
@@ -146,35 +258,25 @@ def P2(theta, u, K, t, S_0, h_j):
 	return np.real(K**(-1j*u)/(1j*u)*phi(theta, u, t, S_0)*h_j)
 
 # The Jacobian
-def jac(theta, S_0_dat, K_dat, t):
-	N = 10
-	grad = np.array(np.zeros(5))
-	Grad = np.matrix(np.zeros((ndat, 5)))
-	for a in range(ndat):
-		S_0 = S_0_dat[a]
-		K = K_dat[a]
-		tot = 0
-		for k in range(N):
-			i = k + 1
-			# Numeric integration
-			if k == 0:
-				k = 0.1
-			# Calculate h(u)
-			h_k = h(theta, K, t, k)
-			h_i = h(theta, K, t, i)
-			# Numeric integration
-			if k == 0:
-				k = 0.1
-			fk_1 = 1/np.pi*(P1(theta, k, K, t, S_0, h_k) - K*P2(theta, k, K, t, S_0, h_k))
-			fk = 1/np.pi*(P1(theta, i, K, t, S_0, h_i) - K*P2(theta, i, K, t, S_0, h_i))
-			h_k = h_i
-			dk = (i - k)/N
-			tot += (fk_1 + fk)/2*dk
-		Grad[a, :] = tot
-	return Grad.T
-
-def flatten(l):
-	return np.array([item for sublist in l for item in sublist])
+def jac(theta, S_0_dat, K_dat, t, cache=None, quad=None, kernel=None):
+	""" The Jacobian of C() with respect to theta, as a (5 x ndat) array.
+		params() and the gradient h() are evaluated once over the
+		(maturities x nodes) grid and shared by both terms of the integrand.
+		The nodes are those of quad, as last used by the pricer, and kernel
+		the kernels backend.
+	"""
+	if quad is None:
+		quad = quadrature.Quadrature()
+	S_0, K, t = grid(S_0_dat, K_dat, t)
+	u, w = quad.nodes()
+	taus, idx = maturities(t)
+	taus = taus[:, None]
+	p_1, p_2, phi_1, phi_2 = cf_terms(theta, u, taus, cache)
+	# The gradient of phi is phi times h, at u - i and at u. h does not
+	# depend on K or S_0, so both products are taken per maturity.
+	grad_1 = phi_1*h(theta, None, taus, u - 1j, p_1)
+	grad_2 = phi_2*h(theta, None, taus, u, p_2)
+	return kernels.backend(kernel).gradient(u, w, np.log(S_0/K), S_0, K, idx, grad_1, grad_2)
 
 ########################################################################
 
@@ -182,79 +284,424 @@ def flatten(l):
 """
 
 
-def LM(S_0_dat, K_dat, V_dat, T):
-	""" This function optimizes our parameters using the Levenberg-Marquardt
-		algorithm.
+# The initial guess at theta
+THETA_0 = np.array([2.0, 0.10, -0.80, 3.00, 0.25])
+
+CalibrationResult = namedtuple('CalibrationResult',
+	['theta', 'iterations', 'stop_reason', 'residual_norm', 'elapsed', 'cache_stats', 'nfev', 'njev'])
+
+STOP_REASONS = {
+	'objective': "Condition 1 met:\nObjective function minimized",
+	'gradient': "Condition 2 met:\nSmall gradient step",
+	'stagnation': "Condition 3 met:\nStagnating update",
+	'max_iter': "The calibration did not converge.",
+	'nonfinite': "The calibration failed:\nThe residues or Jacobian are not finite",
+}
+
+def finite(F, A, g):
+	# Whether the objective and normal equations can be used
+	return np.isfinite(F) and np.isfinite(A).all() and np.isfinite(g).all()
+
+
+class HestonCalibrator:
+	""" Calibrates theta to one dataset with the Levenberg-Marquardt
+		algorithm. The damping mu scales D, the largest diagonal of J J^T
+		seen so far, starting at tau. It is updated by Nielsen's rule, or by
+		the classic factor of ten with damping='marquardt'. geodesic adds the
+		geodesic acceleration correction to each step. Steps are projected
+		back onto THETA_LOWER and THETA_UPPER, and the fit stops once an
+		accepted step reduces the sum of squares by less than ftol relative
+		to it. kernel is the kernels backend, by name or object.
+
+		All of the dataset, settings and solver state live on the object,
+		so separate calibrators can run side by side in threads, and a
+		calibrator can be pickled to run in another process. It never
+		prints; pass a callback to calibrate() to follow its progress.
 	"""
-	global ndat
 
-	ndat = len(K_dat)
-	# The initial guess at theta
-	theta = np.array([2.0, 0.10, -0.80, 3.00, 0.25]).reshape(5,)
+	def __init__(self, S_0_dat, K_dat, V_dat, T, theta0=None, max_iter=2000,
+			thresh1=1e-6, thresh2=1e-8, ftol=1e-10, quad=None, cache_size=16,
+			damping='nielsen', tau=1e-3, geodesic=True, geodesic_h=0.1, geodesic_alpha=0.75, kernel=None):
+		self.S_0_dat = np.asarray(S_0_dat, dtype=float)
+		self.K_dat = np.asarray(K_dat, dtype=float)
+		self.V_dat = np.asarray(V_dat, dtype=float)
+		self.T = T
+		self.theta0 = np.array(THETA_0 if theta0 is None else theta0, dtype=float)
+		self.max_iter = max_iter
+		self.thresh1 = thresh1
+		self.thresh2 = thresh2
+		self.ftol = ftol
+		if damping not in ('nielsen', 'marquardt'):
+			raise ValueError("Unknown damping update %r. Choose 'nielsen' or 'marquardt'." % damping)
+		self.damping = damping
+		self.tau = tau
+		self.geodesic = geodesic
+		self.geodesic_h = geodesic_h
+		self.geodesic_alpha = geodesic_alpha
+		self.quad = quad if quad is not None else quadrature.Quadrature()
+		self.kernel = kernels.backend(kernel)
+		self.cache = CFCache(cache_size)
+
+	def __getstate__(self):
+		# Cached characteristic function terms and the residues and Jacobian
+		# of the last run are not worth shipping
+		state = self.__dict__.copy()
+		state['cache'] = CFCache(self.cache.maxsize)
+		for name in ('_res', '_J', '_trial'):
+			state.pop(name, None)
+		return state
+
+	def residues(self, theta, trace=NULL_TRACE):
+		with trace.phase('residues'):
+			misses = self.cache.misses
+			res = r(theta, self.S_0_dat, self.K_dat, self.V_dat, self.T, self.cache, self.quad, self.kernel)
+		self._count(trace, misses)
+		return res
+
+	def jacobian(self, theta, trace=NULL_TRACE):
+		with trace.phase('jacobian'):
+			misses = self.cache.misses
+			J = jac(theta, self.S_0_dat, self.K_dat, self.T, self.cache, self.quad, self.kernel)
+		self._count(trace, misses)
+		trace.count('h', 2)
+		return J
+
+	def _count(self, trace, misses):
+		# Each cache miss evaluates params() and phi() at u - i and at u
+		new = 2*(self.cache.misses - misses)
+		trace.count('params', new)
+		trace.count('phi', new)
+
+	def calibrate(self, callback=None, trace=None):
+		""" Run the calibration and return a CalibrationResult.
+			callback(i, theta) is called at the start of every iteration.
+			trace is an instrument.Trace to record the run in.
+
+			Each step solves the damped normal equations
+				(J J^T + mu D) dtheta = -J r
+			by Cholesky factorization. The residues and Jacobian of an
+			accepted step are carried into the next iteration, so every
+			iteration costs one residual evaluation, plus a Jacobian when the
+			step is accepted (and one more residual with geodesic).
+		"""
+		if trace is None:
+			trace = NULL_TRACE
+		with trace.profiling():
+			return self._calibrate(callback, trace, self.theta0)
+
+	def _normal_equations(self, theta, trace, trial=False):
+		# F = r.r/2, J J^T and J r at theta. With trial, theta is the point
+		# _objective() was last evaluated at, so its residues are reused.
+		if trial:
+			res = self._trial
+		else:
+			res = self.residues(theta, trace).ravel()
+			self._nfev += 1
+		J = self.jacobian(theta, trace)
+		self._njev += 1
+		self._res, self._J = res, J
+		return res @ res/2, J @ J.T, J @ res
+
+	def _objective(self, theta, trace):
+		# F at a trial point
+		self._trial = self.residues(theta, trace).ravel()
+		self._nfev += 1
+		return self._trial @ self._trial/2
+
+	def _geodesic(self, theta, dtheta, trace):
+		# J r_vv, where r_vv is the second directional derivative of the
+		# residues along dtheta by finite differences
+		res_h = self.residues(theta + self.geodesic_h*dtheta, trace).ravel()
+		self._nfev += 1
+		with trace.phase('solve'):
+			r_vv = 2/self.geodesic_h*((res_h - self._res)/self.geodesic_h - self._J.T @ dtheta)
+			return self._J @ r_vv
+
+	def _calibrate(self, callback, trace, theta0, mu=None, scale=None):
+		# mu and scale, if given, continue the damping of an earlier run.
+		# Their final values are left in self._mu and self._scale.
+		start = time.perf_counter()
+		theta = np.array(theta0, dtype=float)
+		self._nfev, self._njev = 0, 0
+		F, A, g = self._normal_equations(theta, trace)
+		if not finite(F, A, g):
+			return CalibrationResult(theta, 0, 'nonfinite', float(np.sqrt(2*F)), time.perf_counter() - start,
+				self.cache.stats(), self._nfev, self._njev)
+		# Scale the damping by the largest diagonal of J J^T seen so far, since
+		# the columns of J differ by orders of magnitude between parameters.
+		scale = np.diag(A).copy() if scale is None else np.maximum(scale, np.diag(A))
+		mu = self.tau if mu is None else mu
+		nu = 2.0
+		stop_reason = 'max_iter'
+		i = -1 # so that no iterations at all counts as 0
+		for i in range(self.max_iter):
+			iteration_start = time.perf_counter()
+			if callback is not None:
+				callback(i, theta)
+			if np.sqrt(2*F) <= self.thresh1:
+				stop_reason = 'objective'
+				break
+			if np.max(np.abs(g)) <= self.thresh2:
+				stop_reason = 'gradient'
+				break
+			if mu > 1e30:
+				# No step, however short, reduces the residues
+				stop_reason = 'stagnation'
+				break
+			try:
+				with trace.phase('solve'):
+					L = cholesky(A + mu*np.diag(scale))
+					dtheta = cho_solve(L, -g)
+			except np.linalg.LinAlgError:
+				trace.iteration(i, time.perf_counter() - iteration_start, np.sqrt(2*F), mu, np.nan, False)
+				mu, nu = mu*nu, 2*nu
+				continue
+			if np.linalg.norm(dtheta) <= self.thresh2*(np.linalg.norm(theta) + self.thresh2):
+				stop_reason = 'stagnation'
+				break
+			step = dtheta
+			if self.geodesic:
+				# The geodesic acceleration along dtheta
+				rhs = self._geodesic(theta, dtheta, trace)
+				with trace.phase('solve'):
+					accel = cho_solve(L, -rhs)
+				if 2*np.linalg.norm(accel) <= self.geodesic_alpha*np.linalg.norm(dtheta):
+					step = dtheta + accel/2
+			theta_k1 = project(theta + step)
+			F1 = self._objective(theta_k1, trace)
+			# Gain ratio of the actual to the predicted reduction
+			predicted = dtheta @ (mu*scale*dtheta - g)/2
+			gain = (F - F1)/predicted if np.isfinite(F1) and predicted > 0 else -1
+			trace.iteration(i, time.perf_counter() - iteration_start, np.sqrt(2*min(F, F1)), mu, gain, gain > 0)
+			if gain > 0:
+				if F - F1 <= self.ftol*F:
+					theta, F = theta_k1, F1
+					stop_reason = 'stagnation'
+					break
+				theta = theta_k1
+				F, A, g = self._normal_equations(theta, trace, trial=True)
+				if not finite(F, A, g):
+					stop_reason = 'nonfinite'
+					break
+				scale = np.maximum(scale, np.diag(A))
+				if self.damping == 'nielsen':
+					mu *= max(1/3, 1 - (2*gain - 1)**3)
+				else:
+					mu /= 10
+				nu = 2.0
+			elif self.damping == 'nielsen':
+				mu, nu = mu*nu, 2*nu
+			else:
+				mu *= 10
+		self._mu, self._scale = mu, scale
+		return CalibrationResult(theta, i + 1, stop_reason, float(np.sqrt(2*F)), time.perf_counter() - start,
+			self.cache.stats(), self._nfev, self._njev)
+
+
+class ChunkedCalibrator(HestonCalibrator):
+	""" A HestonCalibrator whose memory use does not grow with the dataset.
+		The observations may be memory maps (e.g. dataset.Dataset columns).
+		They are read chunk rows at a time, and only F, J J^T (5 x 5) and
+		J r are accumulated over the chunks, so no residual vector or
+		Jacobian of the whole dataset is ever held. Every pass re-reads the
+		chunks; the geodesic correction takes a second pass per iteration,
+		since it needs the Jacobian again.
+
+		With minibatch, the first minibatch_iter iterations are taken on
+		random samples of minibatch rows, redrawn every minibatch_round
+		iterations, which gets close to the fit for a fraction of the cost of
+		full passes. seed seeds the samples. Other keywords are those of
+		HestonCalibrator.
+	"""
 
-	# Parameters for optimization
-	e = np.ones((ndat, 1))
-	thresh1 = 1e-6   # Threshold
-	thresh2 = 1e-8
+	def __init__(self, S_0_dat, K_dat, V_dat, T, chunk=10000, minibatch=None, minibatch_iter=30,
+			minibatch_round=5, seed=None, **kwargs):
+		HestonCalibrator.__init__(self, [], [], [], T, **kwargs)
+		# asarray does not copy, so memory maps stay on disk
+		self.S_0_dat, self.K_dat, self.V_dat = np.asarray(S_0_dat), np.asarray(K_dat), np.asarray(V_dat)
+		if np.ndim(T):
+			self.T = np.asarray(T)
+		self.chunk = chunk
+		self.minibatch = minibatch
+		self.minibatch_iter = minibatch_iter
+		self.minibatch_round = minibatch_round
+		self.seed = seed
+
+	def __len__(self):
+		return len(self.K_dat)
+
+	def _rows(self, rows):
+		# The observations in rows, read into memory
+		T = self.T if np.ndim(self.T) == 0 else np.asarray(self.T[rows])
+		return (np.asarray(self.S_0_dat[rows], dtype=float), np.asarray(self.K_dat[rows], dtype=float),
+			np.asarray(self.V_dat[rows], dtype=float), T)
+
+	def _chunks(self):
+		for start in range(0, len(self), self.chunk):
+			yield self._rows(slice(start, start + self.chunk))
+
+	def _normal_equations(self, theta, trace, trial=False):
+		F, A, g = 0.0, np.zeros((5, 5)), np.zeros(5)
+		for S_0, K, V, T in self._chunks():
+			with trace.phase('residues'):
+				misses = self.cache.misses
+				res = r(theta, S_0, K, V, T, self.cache, self.quad, self.kernel).ravel()
+			self._count(trace, misses)
+			with trace.phase('jacobian'):
+				misses = self.cache.misses
+				J = jac(theta, S_0, K, T, self.cache, self.quad, self.kernel)
+			self._count(trace, misses)
+			trace.count('h', 2)
+			F += res @ res/2
+			A += J @ J.T
+			g += J @ res
+		self._nfev += 1
+		self._njev += 1
+		return F, A, g
+
+	def _objective(self, theta, trace):
+		F = 0.0
+		for S_0, K, V, T in self._chunks():
+			with trace.phase('residues'):
+				misses = self.cache.misses
+				res = r(theta, S_0, K, V, T, self.cache, self.quad, self.kernel).ravel()
+			self._count(trace, misses)
+			F += res @ res/2
+		self._nfev += 1
+		return F
+
+	def _geodesic(self, theta, dtheta, trace):
+		h = self.geodesic_h
+		rhs = np.zeros(5)
+		for S_0, K, V, T in self._chunks():
+			with trace.phase('residues'):
+				misses = self.cache.misses
+				res = r(theta, S_0, K, V, T, self.cache, self.quad, self.kernel).ravel()
+				res_h = r(theta + h*dtheta, S_0, K, V, T, self.cache, self.quad, self.kernel).ravel()
+			self._count(trace, misses)
+			with trace.phase('jacobian'):
+				misses = self.cache.misses
+				J = jac(theta, S_0, K, T, self.cache, self.quad, self.kernel)
+			self._count(trace, misses)
+			rhs += J @ (2/h*((res_h - res)/h - J.T @ dtheta))
+		self._nfev += 2
+		self._njev += 1
+		return rhs
+
+	def calibrate(self, callback=None, trace=None):
+		""" Run the calibration, after the mini-batch iterations if any, and
+			return a CalibrationResult of the full passes.
+		"""
+		if trace is None:
+			trace = NULL_TRACE
+		theta = self.theta0
+		mu = None
+		with trace.profiling():
+			if self.minibatch and self.minibatch < len(self):
+				rng = np.random.default_rng(self.seed)
+				scale = None
+				for i in range(0, self.minibatch_iter, self.minibatch_round):
+					rows = np.sort(rng.choice(len(self), self.minibatch, replace=False))
+					S_0, K, V, T = self._rows(rows)
+					batch = HestonCalibrator(S_0, K, V, T, theta0=theta, quad=self.quad,
+						max_iter=min(self.minibatch_round, self.minibatch_iter - i), damping=self.damping,
+						tau=self.tau, geodesic=self.geodesic, geodesic_h=self.geodesic_h,
+						geodesic_alpha=self.geodesic_alpha, kernel=self.kernel)
+					batch.cache = self.cache
+					# The damping carries on from round to round
+					result = batch._calibrate(callback, trace, theta, mu, scale)
+					if result.stop_reason == 'nonfinite':
+						break
+					theta, mu, scale = result.theta, batch._mu, batch._scale
+					if mu > 1e30:
+						# This sample was stuck; start the next one afresh
+						mu, scale = None, None
+			# J J^T sums over the rows, so only mu carries over to the full passes
+			return self._calibrate(callback, trace, theta, mu)
+
+
+# Bounds keeping theta a valid set of Heston parameters
+THETA_LOWER = np.array([1e-10, 1e-10, -0.999, 1e-8, 1e-8])
+THETA_UPPER = np.array([np.inf, np.inf, 0.999, np.inf, np.inf])
+
+def project(theta):
+	# The nearest point to theta within the parameter bounds
+	return np.clip(theta, THETA_LOWER, THETA_UPPER)
+
+def cholesky(M):
+	# Lower triangular L with M = L L^T. Raises LinAlgError unless M is positive definite.
+	return np.linalg.cholesky(M)
+
+def cho_solve(L, b):
+	# Solve L L^T x = b given the Cholesky factor L
+	return np.linalg.solve(L.T, np.linalg.solve(L, b))
+
+
+def LM(S_0_dat, K_dat, V_dat, T, quad=None, trace=None, kernel=None):
+	""" This function optimizes our parameters using the Levenberg-Marquardt
+		algorithm. quad is the Quadrature shared by the residues and Jacobian,
+		trace an optional instrument.Trace recording the run, and kernel the
+		kernels backend.
+	"""
+	calibrator = HestonCalibrator(S_0_dat, K_dat, V_dat, T, quad=quad, kernel=kernel)
 
-	print("\nCalibrating...")
-	N = 2000 # max iterations
-	print(f"\nMax Iterations: {N}")
-	v = 2 # inital variance
-	for i in range(N):
-		theta[0] = v
-		res = r(theta, S_0_dat, K_dat, V_dat, T)
-		f = np.linalg.norm(res)
-		J = jac(theta, S_0_dat, K_dat, T)
-		if i == 0:
-			mu = max(np.diagonal(J).copy())
-		deltaf = flatten(np.array(J*res)).reshape(5,1)
-		dtheta = flatten(np.array(1/(J*J.T + mu)*(deltaf)))
-		theta_k1 = theta + dtheta
-		res1 = r(theta_k1, S_0_dat, K_dat, V_dat, T)
-		f1 = np.linalg.norm(res1)
-		dL = np.dot(dtheta.reshape(1,5), mu*dtheta.reshape(5,1) + deltaf)
-		dF = f - f1
+	def progress(i, theta):
 		if i % 15 == 0:
 			print("Iteration %s. Current parameters: %s" % (i, theta))
-		if dF > 0 and dL > 0:
-			theta = theta_k1
-			v = theta[0]
-		else:
-			mu = mu*v
-			v = 2*v
-		if f <= thresh1:
-			print("\nCondition 1 met:")
-			print("Objective function minimized\n")
-			return theta, T
-			break
-		if np.linalg.norm(J*e) <= thresh2:
-			print("\nCondition 2 met:")
-			print("Small gradient step\n")
-			return theta, T
-			break
-		if np.linalg.norm(dtheta)/np.linalg.norm(theta) <= thresh2:
-			print("\nCondition 3 met:")
-			print("Stagnating update\n")
-			return theta, T
-			break
-	print("\nThe calibration did not converge.\n")
-	return theta, T
+
+	print("\nCalibrating...")
+	print(f"\nMax Iterations: {calibrator.max_iter}")
+	result = calibrator.calibrate(progress, trace)
+	print("\n" + STOP_REASONS[result.stop_reason] + "\n")
+	print("Characteristic function cache: %(hits)s hits, %(misses)s misses\n" % result.cache_stats)
+	return result.theta, T
 
 
 if __name__ == "__main__":
-	import gdax
+	import argparse
+	import quotes
+	from instrument import Trace
+	parser = argparse.ArgumentParser()
+	parser.add_argument(
+		"--trace",
+		type=str,
+		default=None,
+		help="Write a calibration trace to this .json or .csv file"
+	)
+	parser.add_argument(
+		"--profile",
+		action="store_true",
+		help="Profile the calibration with cProfile (included in a .json trace)"
+	)
+	parser.add_argument(
+		"--offline",
+		action="store_true",
+		help="Price the coin from the local candle store instead of the exchange"
+	)
+	parser.add_argument(
+		"--kernel",
+		choices=kernels.BACKENDS + ('auto',),
+		default="numpy",
+		help="Backend for the per-observation kernels (numba if installed)"
+	)
+	args = parser.parse_args()
+	trace = Trace(profile=args.profile) if args.trace or args.profile else None
 	S_0_dat, K_dat, V_dat, T, coin = load()
-	theta = LM(S_0_dat, K_dat, V_dat, T)
+	theta, T = LM(S_0_dat, K_dat, V_dat, T, trace=trace, kernel=args.kernel)
 	print("Final parameters:", theta)
-	# Get the current info of the coin
-	pc = gdax.PublicClient()
-	# The name of the coin we're analyzing
-	name = coin + '-USD'
-	stats = pc.get_product_24hr_stats(name)
+	if trace is not None:
+		print("Calibration trace:", trace.summary())
+		if args.trace and args.trace.endswith('.csv'):
+			trace.to_csv(args.trace)
+		elif args.trace:
+			trace.to_json(args.trace)
+		else:
+			print(trace.profile_stats())
 	# Average the 24hr high and low to estimate the current value of the coin
-	S_0 = (float(stats['high']) + float(stats['low']))/2
+	S_0 = quotes.service(offline=args.offline).mid(coin + '-USD')
 	print("\nThe current value of %s is roughly %s USD." % (coin, S_0))
 	# Let's say you want to make 10% after 90 days
 	K = int(S_0*0.9)
+	# A term structure is priced at 90 days
+	T = T if np.ndim(T) == 0 else 90
 	print("If you wanted to make 10 percent profit in 90 days, the expected value of this option is: %s" % (C(theta, S_0, K, T)))
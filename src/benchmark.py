@@ -0,0 +1,154 @@
+#!/usr/bin/env python3
+
+""" Benchmarks for the pricer, the Jacobian and end-to-end calibration.
+	Everything runs offline from fixed seeds: the shipped call_data files,
+	and synthetic datasets priced from a known theta so accuracy can be
+	reported against the truth next to the timings. Results are written as
+	JSON so runs can be compared.
+
+	Run from the repository root:
+		python3 src/benchmark.py --out bench.json
+"""
+
+import argparse
+import json
+import os
+import platform
+import time
+import numpy as np
+import analysis
+import kernels
+import quadrature
+
+# The parameters the synthetic datasets are priced with
+TRUE_THETA = np.array([0.002, 0.003, -0.5, 0.05, 0.02])
+# The calibrations of synthetic data start from here
+SYNTHETIC_START = np.array([0.004, 0.002, -0.3, 0.1, 0.03])
+
+
+def synthetic_quad():
+	# The rule used to price and calibrate the synthetic datasets
+	return quadrature.Quadrature('legendre', n=32, upper=50.0)
+
+def synthetic(ndat, seed=0, T=90):
+	""" A dataset of ndat calls priced exactly from TRUE_THETA.
+	"""
+	rng = np.random.default_rng(seed)
+	S_0 = rng.uniform(100, 400, ndat)
+	K = S_0*rng.uniform(0.7, 1.3, ndat)
+	V = analysis.C_vec(TRUE_THETA, S_0, K, T, quad=synthetic_quad())
+	return S_0, K, V, T
+
+def timeit(f, repeat=5):
+	# The median wall time of f() over repeat calls, after one warm-up call
+	f()
+	times = []
+	for i in range(repeat):
+		start = time.perf_counter()
+		f()
+		times.append(time.perf_counter() - start)
+	return float(np.median(times))
+
+def bench_pricing(S_0, K, T, quad, repeat, kernel=None):
+	seconds = timeit(lambda: analysis.C_vec(TRUE_THETA, S_0, K, T, quad=quad, kernel=kernel), repeat)
+	single = timeit(lambda: analysis.C(TRUE_THETA, S_0[0], K[0], T, quad=quad, kernel=kernel), repeat)
+	return {
+		"ndat": len(S_0),
+		"batch_seconds": seconds,
+		"per_option_seconds": seconds/len(S_0),
+		"single_call_seconds": single,
+	}
+
+def bench_jacobian(S_0, K, T, quad, repeat, kernel=None):
+	seconds = timeit(lambda: analysis.jac(TRUE_THETA, S_0, K, T, quad=quad, kernel=kernel), repeat)
+	return {
+		"ndat": len(S_0),
+		"seconds": seconds,
+		"rows_per_second": len(S_0)/seconds,
+	}
+
+def bench_calibration(S_0, K, V, T, max_iter, truth=None, **kwargs):
+	result = analysis.HestonCalibrator(S_0, K, V, T, max_iter=max_iter, **kwargs).calibrate()
+	out = {
+		"ndat": len(K),
+		"seconds": result.elapsed,
+		"iterations": result.iterations,
+		"nfev": result.nfev,
+		"njev": result.njev,
+		"stop_reason": result.stop_reason,
+		"residual_norm": result.residual_norm,
+		"rmse": result.residual_norm/np.sqrt(len(K)),
+		"theta": [float(x) for x in result.theta],
+	}
+	if truth is not None:
+		out["theta_true"] = [float(x) for x in truth]
+		out["theta_max_rel_error"] = float(np.max(np.abs(result.theta - truth)/np.abs(truth)))
+	return out
+
+def run(sizes=(100, 1000, 10000), data_dir='call_data/', max_iter=200, repeat=5, seed=0, calibrate=True,
+		kernel=None):
+	""" Run the whole suite and return the results as a dict. kernel is
+		the kernels backend to time.
+	"""
+	kernel = kernels.backend(kernel)
+	results = {
+		"meta": {
+			"timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+			"python": platform.python_version(),
+			"numpy": np.__version__,
+			"machine": platform.machine(),
+			"seed": seed,
+			"max_iter": max_iter,
+			"kernel": kernel.name,
+		},
+		"synthetic": [],
+		"call_data": [],
+	}
+	for ndat in sizes:
+		S_0, K, V, T = synthetic(ndat, seed)
+		entry = {
+			"ndat": ndat,
+			"pricing": bench_pricing(S_0, K, T, synthetic_quad(), repeat, kernel),
+			"jacobian": bench_jacobian(S_0, K, T, synthetic_quad(), repeat, kernel),
+		}
+		if calibrate:
+			entry["calibration"] = bench_calibration(S_0, K, V, T, max_iter, TRUE_THETA,
+				theta0=SYNTHETIC_START, quad=synthetic_quad(), kernel=kernel)
+		results["synthetic"].append(entry)
+	if os.path.isdir(data_dir):
+		for name in sorted(os.listdir(data_dir)):
+			if not name.endswith('.csv'):
+				continue
+			S_0, K, V, T, coin = analysis.load_file(os.path.join(data_dir, name))
+			S_0, K, V = np.array(S_0), np.array(K), np.array(V)
+			entry = {
+				"file": name,
+				"coin": coin,
+				"T": T if np.ndim(T) == 0 else np.unique(T).tolist(),
+				"pricing": bench_pricing(S_0, K, T, None, repeat, kernel),
+				"jacobian": bench_jacobian(S_0, K, T, None, repeat, kernel),
+			}
+			if calibrate:
+				entry["calibration"] = bench_calibration(S_0, K, V, T, max_iter, kernel=kernel)
+			results["call_data"].append(entry)
+	return results
+
+
+if __name__ == "__main__":
+	parser = argparse.ArgumentParser()
+	parser.add_argument("--out", type=str, default=None, help="JSON file to write (default: stdout)")
+	parser.add_argument("--sizes", type=int, nargs="+", default=[100, 1000, 10000], help="Synthetic dataset sizes")
+	parser.add_argument("--data-dir", type=str, default="call_data/", help="Directory of shipped datasets")
+	parser.add_argument("--max-iter", type=int, default=200, help="Iteration cap for each calibration")
+	parser.add_argument("--repeat", type=int, default=5, help="Timed repetitions per latency measurement")
+	parser.add_argument("--seed", type=int, default=0, help="Seed for the synthetic datasets")
+	parser.add_argument("--no-calibration", action="store_true", help="Only time the pricer and Jacobian")
+	parser.add_argument("--kernel", choices=kernels.BACKENDS + ('auto',), default="numpy", help="Kernel backend")
+	args = parser.parse_args()
+	results = run(args.sizes, args.data_dir, args.max_iter, args.repeat, args.seed, not args.no_calibration, args.kernel)
+	text = json.dumps(results, indent=1)
+	if args.out is None:
+		print(text)
+	else:
+		with open(args.out, "w") as f:
+			f.write(text + "\n")
@@ -0,0 +1,153 @@
+#!/usr/bin/env python3
+
+""" An on-disk store of calibrated parameters.
+	Each calibration is saved as a JSON file in `calibrations/`, keyed by
+	the coin, the maturity and a fingerprint of the dataset it was fit to
+	and of the solver settings. If the same dataset is calibrated again with
+	the same settings, a converged result is returned straight away, and
+	otherwise the calibration is warm-started from the stored theta of the
+	same coin with the nearest maturity. A term structure (an array T) is
+	filed as "multi" and compared with other calibrations by its median
+	maturity.
+"""
+
+import hashlib
+import inspect
+import json
+import os
+import time
+import numpy as np
+import analysis
+import kernels
+import quadrature
+
+# Stop reasons of stored calibrations that are returned without refitting
+CONVERGED = ('objective', 'gradient', 'stagnation')
+
+
+def fingerprint(S_0_dat, K_dat, V_dat, T, settings=None):
+	""" A hash identifying a dataset by its contents, and the settings
+		(from settings()) it is calibrated with.
+	"""
+	data = np.ascontiguousarray([S_0_dat, K_dat, V_dat], dtype=float)
+	digest = hashlib.sha1(data.tobytes())
+	digest.update(np.ascontiguousarray(T, dtype=float).tobytes())
+	if settings is not None:
+		digest.update(json.dumps(settings, sort_keys=True).encode())
+	return digest.hexdigest()[:16]
+
+def settings(kwargs):
+	""" The analysis.HestonCalibrator settings that kwargs amount to, with
+		the defaults filled in, as JSON-able values. theta0 is left out, as
+		it only decides where the fit starts.
+	"""
+	parameters = inspect.signature(analysis.HestonCalibrator.__init__).parameters
+	out = {name: p.default for name, p in parameters.items() if p.default is not inspect.Parameter.empty}
+	out.update(kwargs)
+	out.pop('theta0', None)
+	quad = out['quad'] if out['quad'] is not None else quadrature.Quadrature()
+	out['quad'] = [quad.rule, quad.n, quad.upper, quad.lower, quad.tol]
+	out['kernel'] = kernels.backend(out['kernel']).name
+	return out
+
+def label(T):
+	""" How maturity T appears in file names: the number of days, or
+		"multi" for a term structure.
+	"""
+	days = np.unique(T)
+	return int(days[0]) if len(days) == 1 else "multi"
+
+def maturity(T):
+	""" The representative maturity of T, in days.
+	"""
+	return float(np.median(T))
+
+
+class CalibrationStore:
+	""" Saved calibrations in directory, one file per (coin, T, fingerprint).
+	"""
+
+	def __init__(self, directory='calibrations/'):
+		self.directory = directory
+
+	def _path(self, coin, T, fp):
+		return os.path.join(self.directory, "%s_%s_%s.json" % (coin, label(T), fp))
+
+	def records(self, coin=None):
+		""" Every stored record, optionally only those of one coin.
+		"""
+		if not os.path.isdir(self.directory):
+			return []
+		records = []
+		for name in sorted(os.listdir(self.directory)):
+			if not name.endswith('.json') or (coin is not None and name.split("_")[0] != coin):
+				continue
+			with open(os.path.join(self.directory, name), 'r') as f:
+				records.append(json.load(f))
+		return records
+
+	def get(self, coin, T, fp):
+		""" The record for exactly this dataset, or None.
+		"""
+		try:
+			with open(self._path(coin, T, fp), 'r') as f:
+				return json.load(f)
+		except FileNotFoundError:
+			return None
+
+	def nearest(self, coin, T):
+		""" The record of coin with maturity closest to T, the most recently
+			updated one on ties. None if the coin was never calibrated.
+		"""
+		records = [rec for rec in self.records(coin) if np.all(np.isfinite(rec['theta']))]
+		if not records:
+			return None
+		return min(records, key=lambda rec: (abs(rec['T'] - maturity(T)), -rec['updated']))
+
+	def save(self, coin, T, fp, result, ndat=None, settings=None):
+		""" Save a CalibrationResult and return the stored record.
+		"""
+		previous = self.get(coin, T, fp)
+		now = time.time()
+		record = {
+			'coin': coin,
+			'T': maturity(T),
+			'maturities': [int(t) for t in np.unique(T)],
+			'fingerprint': fp,
+			'settings': settings,
+			'ndat': ndat,
+			'theta': [float(x) for x in result.theta],
+			'iterations': result.iterations,
+			'nfev': result.nfev,
+			'njev': result.njev,
+			'stop_reason': result.stop_reason,
+			'residual_norm': result.residual_norm,
+			'elapsed': result.elapsed,
+			'created': previous['created'] if previous else now,
+			'updated': now,
+		}
+		os.makedirs(self.directory, exist_ok=True)
+		# Write to a temporary file first so readers never see a partial record
+		path = self._path(coin, T, fp)
+		tmp = "%s.%s.tmp" % (path, os.getpid())
+		with open(tmp, 'w') as f:
+			json.dump(record, f, indent=1)
+		os.replace(tmp, path)
+		return record
+
+	def calibrate(self, S_0_dat, K_dat, V_dat, T, coin, **kwargs):
+		""" Calibrate a dataset through the store. Returns the record and
+			whether it came straight from the store, which it does only for a
+			converged fit with the same settings. kwargs are passed on to
+			analysis.HestonCalibrator.
+		"""
+		used = settings(kwargs)
+		fp = fingerprint(S_0_dat, K_dat, V_dat, T, used)
+		record = self.get(coin, T, fp)
+		if record is not None and record['stop_reason'] in CONVERGED and np.isfinite(record['residual_norm']):
+			return record, True
+		prior = self.nearest(coin, T)
+		if prior is not None and 'theta0' not in kwargs:
+			kwargs['theta0'] = prior['theta']
+		result = analysis.HestonCalibrator(S_0_dat, K_dat, V_dat, T, **kwargs).calibrate()
+		return self.save(coin, T, fp, result, len(K_dat), used), False
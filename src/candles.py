@@ -0,0 +1,195 @@
+#!/usr/bin/env python3
+
+""" A local store of daily candles for each product.
+	The first update of a product downloads its whole history, walking back
+	from today in pages of 300 candles (the most Coinbase returns at once).
+	Later updates only fetch the days since the last stored candle. Once a
+	product is stored, prices can be looked up without touching the network.
+
+	Candles are saved one file per product in `candles/`, oldest first, with
+	the columns Coinbase uses:
+		time, low, high, open, close, volume
+"""
+
+import asyncio
+import os
+import time
+import numpy as np
+
+FIELDS = ['time', 'low', 'high', 'open', 'close', 'volume']
+PAGE = 300 # candles per request
+DAY = 86400
+
+
+def _today(now=None):
+	# The unix time of the start of the current (or given) day
+	if now is None:
+		now = time.time()
+	return int(now//DAY*DAY)
+
+def _check(product_id, page):
+	# Candles come back newest first, or as a dict holding an error message
+	if isinstance(page, dict):
+		raise RuntimeError("Unable to fetch candles for %s: %s" % (product_id, page.get('message', page)))
+	return sorted(page)
+
+
+class CandleStore:
+	""" Daily candles kept on disk in directory. client is anything with
+		gdax.PublicClient's get_product_historic_rates() (a gdax.PublicClient
+		is created on first use if none is given). pause is the time to wait
+		between page requests.
+	"""
+
+	def __init__(self, directory='candles/', client=None, pause=0.4):
+		self.directory = directory
+		self.client = client
+		self.pause = pause
+		self._loaded = {}
+
+	def _path(self, product_id):
+		return os.path.join(self.directory, product_id + '.csv')
+
+	def _client(self):
+		if self.client is None:
+			import gdax
+			self.client = gdax.PublicClient()
+		return self.client
+
+	def _page(self, product_id, start, end):
+		# One request for the candles between two unix times, oldest first
+		page = self._client().get_product_historic_rates(
+			product_id=product_id,
+			start=np.datetime64(int(start), 's'),
+			end=np.datetime64(int(end), 's'),
+			granularity=DAY
+		)
+		if self.pause:
+			time.sleep(self.pause)
+		return _check(product_id, page)
+
+	def load(self, product_id):
+		""" The stored candles of product_id as an (n x 6) array, oldest
+			first. Empty if the product has never been fetched.
+		"""
+		if product_id not in self._loaded:
+			path = self._path(product_id)
+			if os.path.exists(path):
+				candles = np.loadtxt(path, delimiter=',', ndmin=2)
+			else:
+				candles = np.zeros((0, len(FIELDS)))
+			self._loaded[product_id] = candles
+		return self._loaded[product_id]
+
+	def save(self, product_id, candles):
+		os.makedirs(self.directory, exist_ok=True)
+		path = self._path(product_id)
+		tmp = path + '.tmp'
+		np.savetxt(tmp, candles, delimiter=',', fmt='%.10g')
+		os.replace(tmp, path)
+		self._loaded[product_id] = candles
+
+	def _requests(self, product_id, now):
+		""" Generates the (start, end) of each page to request for
+			product_id. Each page received must be sent back in.
+		"""
+		candles = self.load(product_id)
+		if len(candles) == 0:
+			# Walk back until a page comes back short of 300 candles
+			end = now
+			while True:
+				page = yield end - (PAGE - 1)*DAY, end
+				if len(page) < PAGE:
+					return
+				end -= PAGE*DAY
+		else:
+			# Start from the last stored day, whose candle may have been partial
+			start = int(candles[-1, 0])
+			while start <= now:
+				end = min(start + (PAGE - 1)*DAY, now)
+				yield start, end
+				start = end + DAY
+
+	def _merge(self, product_id, pages):
+		# Add the fetched pages to the store, returning the number of new candles
+		candles = self.load(product_id)
+		new = [row for page in pages for row in page]
+		if not new:
+			return 0
+		merged = np.concatenate((np.array(new, dtype=float)[:, :len(FIELDS)], candles))
+		# Keep one candle per day, preferring the freshly fetched one
+		times, idx = np.unique(merged[:, 0], return_index=True)
+		merged = merged[idx]
+		self.save(product_id, merged)
+		return len(merged) - len(candles)
+
+	def update(self, product_id, now=None):
+		""" Fetch any candles of product_id missing from the store: its whole
+			history the first time, and afterwards only the days since the
+			last stored candle. Returns the number of new candles.
+		"""
+		requests = self._requests(product_id, _today(now))
+		pages = []
+		page = None
+		try:
+			while True:
+				start, end = requests.send(page)
+				page = self._page(product_id, start, end)
+				pages.append(page)
+		except StopIteration:
+			pass
+		return self._merge(product_id, pages)
+
+	async def update_async(self, product_id, client, now=None):
+		""" update() through a fetch.AsyncPublicClient.
+		"""
+		requests = self._requests(product_id, _today(now))
+		pages = []
+		page = None
+		try:
+			while True:
+				start, end = requests.send(page)
+				page = _check(product_id, await client.get_product_historic_rates(
+					product_id,
+					start=np.datetime64(int(start), 's'),
+					end=np.datetime64(int(end), 's'),
+					granularity=DAY
+				))
+				pages.append(page)
+		except StopIteration:
+			pass
+		return self._merge(product_id, pages)
+
+	def update_many(self, product_ids, client=None, now=None):
+		""" Update several products concurrently, sharing one rate-limited
+			fetch.AsyncPublicClient. Returns the new candle count of each.
+		"""
+		async def update_all(client):
+			return await asyncio.gather(*(self.update_async(p, client, now) for p in product_ids))
+
+		async def main():
+			if client is not None:
+				return await update_all(client)
+			from fetch import AsyncPublicClient
+			async with AsyncPublicClient() as own_client:
+				return await update_all(own_client)
+
+		return dict(zip(product_ids, asyncio.run(main())))
+
+	def series(self, product_id, field='open'):
+		""" The dates (datetime64[D]) and prices of one candle field.
+			sample_calls has always used the open of each day.
+		"""
+		candles = self.load(product_id)
+		dates = candles[:, 0].astype('int64').astype('datetime64[s]').astype('datetime64[D]')
+		return dates, candles[:, FIELDS.index(field)]
+
+	def price_on(self, product_id, dates, field='open'):
+		""" The price on each of dates, NaN where the store has no candle.
+		"""
+		known, prices = self.series(product_id, field)
+		dates = np.atleast_1d(np.asarray(dates, dtype='datetime64[D]'))
+		idx = np.clip(np.searchsorted(known, dates), 0, max(len(known) - 1, 0))
+		if len(known) == 0:
+			return np.full(len(dates), np.nan)
+		return np.where(known[idx] == dates, prices[idx], np.nan)
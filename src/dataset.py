@@ -0,0 +1,169 @@
+#!/usr/bin/env python3
+
+""" A columnar, memory-mapped store of synthetic options.
+	Every option is a row of the typed columns
+
+		date (datetime64[D]), S_0, K, value (float64), T (int32), coin (int16)
+
+	each saved as its own .npy file in `datasets/`. Rows are sorted by coin,
+	then maturity, then date, and index.json records the rows of each
+	(coin, T) group, so selecting a coin or a coin and maturity is a slice
+	of the memory map: nothing is parsed or copied until it is used.
+
+	Convert the existing CSVs once with
+		python3 src/dataset.py call_data/*.csv
+"""
+
+import hashlib
+import json
+import os
+import numpy as np
+
+COLUMNS = {
+	'date': 'datetime64[D]',
+	'S_0': 'float64',
+	'K': 'float64',
+	'value': 'float64',
+	'T': 'int32',
+	'coin': 'int16',
+}
+
+
+def read_csv(path):
+	""" The rows of one call_data file as a dict of columns. The coin, and
+		the maturity unless the file has a fifth column, come from the
+		name COIN_DATE_MATURITY.csv.
+	"""
+	name = os.path.splitext(os.path.basename(path))[0]
+	with open(path, 'r') as f:
+		rows = [line.strip().split(', ') for line in f if line.strip()]
+	columns = {
+		'date': np.array([row[0] for row in rows], dtype='datetime64[D]'),
+		'S_0': np.array([float(row[1]) for row in rows]),
+		'K': np.array([float(row[2]) for row in rows]),
+		'value': np.array([float(row[3]) for row in rows]),
+	}
+	if rows and len(rows[0]) > 4:
+		columns['T'] = np.array([int(row[4]) for row in rows], dtype='int32')
+	else:
+		try:
+			T = int(name.split("_")[2])
+		except Exception:
+			T = 90
+		columns['T'] = np.full(len(rows), T, dtype='int32')
+	columns['coin'] = np.full(len(rows), name.split("_")[0])
+	return columns
+
+
+class Dataset:
+	""" The store in directory, opened as read-only memory maps.
+	"""
+
+	def __init__(self, directory='datasets/'):
+		self.directory = directory
+		with open(os.path.join(directory, 'index.json'), 'r') as f:
+			self.index = json.load(f)
+		self.coins = self.index['coins']
+		self.columns = {name: np.load(os.path.join(directory, name + '.npy'), mmap_mode='r') for name in COLUMNS}
+
+	def __len__(self):
+		return self.index['rows']
+
+	def fingerprint(self):
+		""" A hash of the contents of the store.
+		"""
+		digest = hashlib.sha1(json.dumps(self.index, sort_keys=True).encode())
+		for name in COLUMNS:
+			digest.update(np.ascontiguousarray(self.columns[name]).tobytes())
+		return digest.hexdigest()[:16]
+
+	def groups(self, coin=None, T=None):
+		""" The (coin, T, start, stop) of each group matching coin and T.
+		"""
+		return [(g['coin'], g['T'], g['start'], g['stop']) for g in self.index['groups']
+			if (coin is None or g['coin'] == coin) and (T is None or g['T'] == T)]
+
+	def rows(self, coin=None, T=None):
+		""" The slice, or index array if the rows are not contiguous, of the
+			rows matching coin and T.
+		"""
+		groups = self.groups(coin, T)
+		if not groups:
+			return slice(0, 0)
+		if all(a[3] == b[2] for a, b in zip(groups, groups[1:])):
+			return slice(groups[0][2], groups[-1][3])
+		return np.concatenate([np.arange(start, stop) for c, t, start, stop in groups])
+
+	def select(self, coin=None, T=None):
+		""" The columns of the rows matching coin and T. A single coin (with
+			or without T) is a contiguous slice, so these are views of the
+			memory maps; selections across coins are copied.
+		"""
+		rows = self.rows(coin, T)
+		return {name: column[rows] for name, column in self.columns.items()}
+
+	def calibration_data(self, coin, T=None):
+		""" S_0, K, value and T of coin, in the form HestonCalibrator takes.
+		"""
+		data = self.select(coin, T)
+		return data['S_0'], data['K'], data['value'], data['T']
+
+
+def write(columns, directory='datasets/'):
+	""" Write a dict of columns (with coin as names) as a store in directory,
+		replacing what was there. Returns the opened Dataset.
+	"""
+	coins = sorted(set(columns['coin'].tolist()))
+	codes = np.searchsorted(coins, columns['coin']).astype('int16')
+	order = np.lexsort((columns['date'], columns['T'], codes))
+	os.makedirs(directory, exist_ok=True)
+	for name, dtype in COLUMNS.items():
+		column = codes if name == 'coin' else columns[name]
+		np.save(os.path.join(directory, name + '.npy'), np.asarray(column, dtype=dtype)[order])
+	codes, T = codes[order], np.asarray(columns['T'])[order]
+	# A group starts wherever the coin or the maturity changes
+	starts = np.flatnonzero(np.r_[True, (codes[1:] != codes[:-1]) | (T[1:] != T[:-1])])
+	stops = np.r_[starts[1:], len(order)]
+	index = {
+		'rows': int(len(order)),
+		'coins': coins,
+		'groups': [{'coin': coins[codes[a]], 'T': int(T[a]), 'start': int(a), 'stop': int(b)} for a, b in zip(starts, stops)],
+	}
+	with open(os.path.join(directory, 'index.json'), 'w') as f:
+		json.dump(index, f, indent=1)
+	return Dataset(directory)
+
+
+def convert(paths, directory='datasets/', replace=False):
+	""" Convert call_data CSV files into a store in directory, together
+		with any rows already in it. A converted option replaces a stored one
+		of the same coin, date and maturity, so converting a file twice does
+		not duplicate it. With replace, every stored row of the coins in
+		paths is dropped first, so those coins hold only the new rows.
+	"""
+	parts = [read_csv(path) for path in paths]
+	if os.path.exists(os.path.join(directory, 'index.json')):
+		existing = Dataset(directory)
+		data = existing.select()
+		data['coin'] = np.array(existing.coins)[data['coin']]
+		if replace:
+			keep = ~np.isin(data['coin'], [part['coin'][0] for part in parts if len(part['coin'])])
+			data = {name: column[keep] for name, column in data.items()}
+		parts.insert(0, data)
+	columns = {name: np.concatenate([np.asarray(part[name]) for part in parts]) for name in COLUMNS}
+	# Keep the last row of each (coin, date, T), i.e. the newest conversion
+	keys = np.rec.fromarrays([columns['coin'], columns['date'], columns['T']])[::-1]
+	keep = len(keys) - 1 - np.unique(keys, return_index=True)[1]
+	return write({name: column[keep] for name, column in columns.items()}, directory)
+
+
+if __name__ == "__main__":
+	import argparse
+	parser = argparse.ArgumentParser()
+	parser.add_argument("paths", nargs="+", help="call_data CSV files to convert")
+	parser.add_argument("--directory", type=str, default="datasets/", help="Where the store is kept")
+	args = parser.parse_args()
+	dataset = convert(args.paths, args.directory)
+	print("%s rows in %s:" % (len(dataset), args.directory))
+	for coin, T, start, stop in dataset.groups():
+		print("%s %s days: %s options" % (coin, T, stop - start))
@@ -0,0 +1,152 @@
+#!/usr/bin/env python3
+
+""" Asynchronous access to the Coinbase public market data API.
+	Requests share one pooled HTTP session and are paced by a token bucket
+	at the exchange's public rate limit (3 requests a second, bursts of 6)
+	instead of fixed sleeps. Rate-limited (429) and server error responses
+	are retried with exponential backoff.
+
+	The method names follow gdax.PublicClient, but are coroutines:
+
+		async with AsyncPublicClient() as client:
+			stats = await client.gather(client.get_product_24hr_stats(p) for p in products)
+
+	Requires aiohttp. base_url can point at any server speaking the same
+	API, e.g. a local fake for testing.
+"""
+
+import asyncio
+import random
+import time
+import numpy as np
+
+API_URL = 'https://api.exchange.coinbase.com'
+
+
+class RateLimitError(Exception):
+	""" Raised when a request still fails after every retry.
+	"""
+
+
+class TokenBucket:
+	""" Allows rate acquisitions a second on average, and up to capacity at
+		once after a quiet period.
+	"""
+
+	def __init__(self, rate=3.0, capacity=6):
+		self.rate = rate
+		self.capacity = capacity
+		self.tokens = float(capacity)
+		self.updated = time.monotonic()
+		self._lock = asyncio.Lock()
+
+	def _refill(self):
+		now = time.monotonic()
+		self.tokens = min(self.capacity, self.tokens + (now - self.updated)*self.rate)
+		self.updated = now
+
+	async def acquire(self):
+		async with self._lock:
+			self._refill()
+			while self.tokens < 1:
+				await asyncio.sleep((1 - self.tokens)/self.rate)
+				self._refill()
+			self.tokens -= 1
+
+
+class AsyncPublicClient:
+	""" A pooled, rate-limited client for the public endpoints.
+		rate and burst set the token bucket, concurrency the number of
+		connections in the pool, and retries and backoff how failed requests
+		are repeated: after backoff*2**attempt seconds (with jitter), or the
+		server's Retry-After if it sends one.
+	"""
+
+	def __init__(self, base_url=API_URL, rate=3.0, burst=6, concurrency=10, retries=5, backoff=0.5, timeout=30):
+		self.base_url = base_url.rstrip('/')
+		self.rate = rate
+		self.burst = burst
+		self.concurrency = concurrency
+		self.retries = retries
+		self.backoff = backoff
+		self.timeout = timeout
+		self.requests = 0
+		self._session = None
+		self._bucket = None
+
+	async def __aenter__(self):
+		await self.open()
+		return self
+
+	async def __aexit__(self, *exc):
+		await self.close()
+
+	async def open(self):
+		import aiohttp
+		if self._session is None:
+			self._bucket = TokenBucket(self.rate, self.burst)
+			self._session = aiohttp.ClientSession(
+				connector=aiohttp.TCPConnector(limit=self.concurrency),
+				timeout=aiohttp.ClientTimeout(total=self.timeout),
+				headers={'User-Agent': 'Crypto_stochvol'},
+			)
+
+	async def close(self):
+		if self._session is not None:
+			await self._session.close()
+			self._session = None
+
+	async def _get(self, path, params=None):
+		import aiohttp
+		await self.open()
+		url = self.base_url + path
+		for attempt in range(self.retries + 1):
+			await self._bucket.acquire()
+			self.requests += 1
+			delay = self.backoff*2**attempt*(1 + random.random()/2)
+			try:
+				async with self._session.get(url, params=params) as resp:
+					if resp.status == 429 or resp.status >= 500:
+						retry_after = resp.headers.get('Retry-After')
+						if retry_after is not None:
+							delay = float(retry_after)
+						error = "HTTP %s from %s" % (resp.status, url)
+					else:
+						resp.raise_for_status()
+						return await resp.json()
+			except (aiohttp.ClientConnectionError, asyncio.TimeoutError) as e:
+				error = "%s from %s" % (type(e).__name__, url)
+			if attempt < self.retries:
+				await asyncio.sleep(delay)
+		raise RateLimitError("%s after %s attempts" % (error, self.retries + 1))
+
+	async def get_products(self):
+		return await self._get('/products')
+
+	async def get_time(self):
+		return await self._get('/time')
+
+	async def get_product_24hr_stats(self, product_id):
+		return await self._get('/products/%s/stats' % product_id)
+
+	async def get_product_historic_rates(self, product_id, start=None, end=None, granularity=None):
+		params = {}
+		if start is not None:
+			params['start'] = str(np.datetime64(start))
+		if end is not None:
+			params['end'] = str(np.datetime64(end))
+		if granularity is not None:
+			params['granularity'] = str(granularity)
+		return await self._get('/products/%s/candles' % product_id, params)
+
+	@staticmethod
+	async def gather(coros):
+		""" Run the requests concurrently and return their results in order.
+		"""
+		return await asyncio.gather(*coros)
+
+
+def run(coro):
+	""" Run a coroutine from blocking code.
+	"""
+	return asyncio.run(coro)
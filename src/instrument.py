@@ -0,0 +1,127 @@
+#!/usr/bin/env python3
+
+""" Instrumentation for calibration runs.
+	A Trace passed to HestonCalibrator.calibrate() records
+		* counts of params(), phi() and h() evaluations
+		* wall time spent in each phase (residues, jacobian, solve)
+		* one row per iteration: time, mu, gain ratio and whether the step
+		  was accepted
+	and can profile the run with cProfile. It exports to JSON or CSV.
+	Without a trace the calibrator uses NULL_TRACE, which does nothing.
+"""
+
+import cProfile
+import csv
+import io
+import json
+import pstats
+import time
+from contextlib import contextmanager, nullcontext
+
+ITERATION_FIELDS = ['iteration', 'seconds', 'residual_norm', 'mu', 'gain', 'accepted']
+
+
+class Trace:
+	""" Collects counters, phase timings and the per-iteration history of
+		one or more calibrations. With profile set, calibrations also run
+		under cProfile and profile_stats() summarises them.
+	"""
+
+	enabled = True
+
+	def __init__(self, profile=False):
+		self.counts = {}
+		self.phases = {}
+		self.iterations = []
+		self.profiler = cProfile.Profile() if profile else None
+
+	def count(self, name, n=1):
+		self.counts[name] = self.counts.get(name, 0) + n
+
+	@contextmanager
+	def phase(self, name):
+		start = time.perf_counter()
+		try:
+			yield
+		finally:
+			self.phases[name] = self.phases.get(name, 0.0) + time.perf_counter() - start
+
+	@contextmanager
+	def profiling(self):
+		if self.profiler is None:
+			yield
+			return
+		self.profiler.enable()
+		try:
+			yield
+		finally:
+			self.profiler.disable()
+
+	def iteration(self, i, seconds, residual_norm, mu, gain, accepted):
+		self.iterations.append({
+			'iteration': i,
+			'seconds': seconds,
+			'residual_norm': float(residual_norm),
+			'mu': float(mu),
+			'gain': float(gain),
+			'accepted': bool(accepted),
+		})
+
+	def profile_stats(self, sort='cumulative', limit=25):
+		""" The cProfile report as text, or None if not profiling.
+		"""
+		if self.profiler is None:
+			return None
+		out = io.StringIO()
+		pstats.Stats(self.profiler, stream=out).sort_stats(sort).print_stats(limit)
+		return out.getvalue()
+
+	def summary(self):
+		accepted = sum(row['accepted'] for row in self.iterations)
+		return {
+			'counts': dict(self.counts),
+			'phases': dict(self.phases),
+			'iterations': len(self.iterations),
+			'accepted': accepted,
+			'rejected': len(self.iterations) - accepted,
+		}
+
+	def to_json(self, path):
+		""" Write the summary and iteration history as JSON.
+		"""
+		out = self.summary()
+		out['history'] = self.iterations
+		if self.profiler is not None:
+			out['profile'] = self.profile_stats()
+		with open(path, 'w') as f:
+			json.dump(out, f, indent=1)
+
+	def to_csv(self, path):
+		""" Write the iteration history as CSV, one row per iteration.
+		"""
+		with open(path, 'w', newline='') as f:
+			writer = csv.DictWriter(f, fieldnames=ITERATION_FIELDS)
+			writer.writeheader()
+			writer.writerows(self.iterations)
+
+
+class NullTrace:
+	""" A Trace that records nothing, for calibrations run without one.
+	"""
+
+	enabled = False
+
+	def count(self, name, n=1):
+		pass
+
+	def phase(self, name):
+		return nullcontext()
+
+	def profiling(self):
+		return nullcontext()
+
+	def iteration(self, *args):
+		pass
+
+
+NULL_TRACE = NullTrace()
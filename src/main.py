@@ -4,8 +4,14 @@
 """
 
 import analysis, sample_calls    # The scripts this project uses
-import gdax
+from calibration_store import CalibrationStore
+from candles import CandleStore
+import portfolio as optimizer
+import quotes
+import simulate
 
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import os
 from os import listdir
 import numpy as np
 
@@ -64,6 +70,51 @@ def analyze():
 			print("\nUnable to interpret input. Please try again.")
 	return params
 
+def calibrate_file(path, store_dir='calibrations/'):
+	""" Calibrate a call_data file through the calibration store, so
+		unchanged datasets are not recalibrated. path may also be a list of
+		files of one coin, which are fit together as a term structure. This
+		runs in a worker process, so it returns the record rather than
+		printing it.
+	"""
+	if isinstance(path, str):
+		S_0_dat, K_dat, V_dat, T, coin = analysis.load_file(path)
+	else:
+		S_0_dat, K_dat, V_dat, T, coin = analysis.load_files(path)
+	record, cached = CalibrationStore(store_dir).calibrate(S_0_dat, K_dat, V_dat, T, coin)
+	return [np.array(record['theta']), T, coin]
+
+def calibrate_all(paths=None, workers=None, store_dir='calibrations/', joint=False):
+	""" Calibrate every dataset in paths (all of call_data/ by default)
+		concurrently on a pool of workers processes. Yields each
+		(path, [theta, T, coin]) record as soon as its job finishes. With
+		joint, the files of each coin are calibrated together, and path is
+		the tuple of them.
+	"""
+	if paths is None:
+		paths = ['call_data/' + name for name in sorted(listdir('call_data/')) if name.endswith('.csv')]
+	if joint:
+		coins = {}
+		for path in paths:
+			coins.setdefault(path.split('/')[-1].split("_")[0], []).append(path)
+		paths = [tuple(group) for group in coins.values()]
+	with ProcessPoolExecutor(max_workers=workers) as pool:
+		jobs = {pool.submit(calibrate_file, path, store_dir): path for path in paths}
+		for job in as_completed(jobs):
+			yield jobs[job], job.result()
+
+def analyze_batch(paths=None, workers=None, joint=False):
+	""" Non-interactive counterpart of analyze(). Returns the same
+		[theta, T, coin] records for generate_portfolio().
+	"""
+	params = []
+	print("\nCalibrating datasets...")
+	for path, record in calibrate_all(paths, workers, joint=joint):
+		print("%s: %s" % (path, record[0]))
+		params.append(record)
+	print("\nFinal parameters:", params)
+	return params
+
 def invest():
 	""" Simple script for obaining the amount desired to invest
 	"""
@@ -77,30 +128,81 @@ def invest():
 			print("Unable to convert to suitable format. Please try again.")
 	return S_0
 
-def generate_portfolio(S_0, params):
+def correlation(product_ids, store=None):
+	""" The correlation of the daily returns of the products in the candle
+		store, or None (independent) if it has too little common history.
+	"""
+	store = store if store is not None else CandleStore()
+	if any(len(store.load(p)) == 0 for p in product_ids):
+		return None
+	returns = optimizer.candle_returns(store, product_ids)
+	if len(returns) < 2*len(product_ids):
+		return None
+	return np.corrcoef(returns, rowvar=False).reshape(len(product_ids), len(product_ids))
+
+def unique_coins(params):
+	""" params with one record per coin. A coin calibrated more than once
+		(e.g. to a single maturity and to a term structure) keeps the record
+		covering the most maturities, or the last one among equals.
+	"""
+	best = {}
+	for coin in params:
+		span = len(np.unique(coin[1]))
+		if coin[2] not in best or span >= len(np.unique(best[coin[2]][1])):
+			best[coin[2]] = coin
+	return [coin for coin in params if best[coin[2]] is coin]
+
+def plan_portfolio(S_0, params, method='mean-variance', paths=20000, store=None, steps=4, samples=1000000):
+	""" The (id, currency, investment) of each coin in params for an
+		investment of S_0 USD. The allocation minimizes the variance implied
+		by each coin's calibrated theta (method='mean-variance'), or the
+		expected shortfall of simulated returns (method='cvar'), over the
+		calibrated maturity. Coins are correlated as in their candle
+		history, where there is one. A coin in params more than once is
+		allocated once, by unique_coins().
+
+		Only the returns at the horizon matter to the allocation, so the
+		cvar paths take steps QE steps over the whole horizon, and there
+		are at most samples returns in all: paths, or fewer with many
+		coins. The defaults plan every USD product (200 to 500 coins) in
+		about two seconds, most of it in optimizer.cvar(), against close
+		to a minute with daily steps and 20000 paths per coin.
+	"""
+	if method not in ('mean-variance', 'cvar'):
+		raise ValueError("Unknown allocation method %r. Choose 'mean-variance' or 'cvar'." % method)
+	params = unique_coins(params)
+	ids = [coin[2] for coin in params]
+	thetas = np.array([coin[0] for coin in params])
+	horizon = float(np.median(np.concatenate([np.ravel(coin[1]) for coin in params])))
+	# Get the current value of every coin, i.e. how much you bought, at once
+	prices = quotes.service().mids(coin_id + '-USD' for coin_id in ids)
+	prices = [prices[coin_id + '-USD'] for coin_id in ids]
+	corr = correlation([coin_id + '-USD' for coin_id in ids], store)
+	if method == 'cvar':
+		paths = min(paths, max(samples//len(ids), 1000))
+		returns = simulate.sample_returns(thetas, horizon, paths, corr=corr, steps_per_day=steps/horizon)
+		weights = optimizer.cvar(returns)
+	else:
+		cov = optimizer.heston_covariance(thetas, horizon, corr)
+		weights = optimizer.mean_variance(np.zeros(len(ids)), cov)
+	return optimizer.allocate(S_0, ids, prices, weights)
+
+def save_portfolio(portfolio, directory='portfolios/'):
+	""" Save a portfolio under the current date, returning its path.
+	"""
+	current_date = quotes.service().server_date()
+	os.makedirs(directory, exist_ok=True)
+	path = os.path.join(directory, "%s.txt" % (current_date))
+	with open(path, "w") as f:
+		for coin in portfolio:
+			f.write(str(coin[0]) + ', ' + str(coin[1]) + ', ' + str(coin[2]) + '\n')
+	return path
+
+def generate_portfolio(S_0, params, method='mean-variance', paths=20000):
 	""" This script analyzes possible portfolios based on the calculated
 		parameters on the observed data, and the user inputted investment.
 	"""
-	public_client = gdax.PublicClient()
-	allvar = []
-	sumvar = 0
-	for coin in params:
-		theta = coin[0]
-		v = theta[0]
-		T = coin[1]
-		prod_id = coin[2]
-		# Get the current value of the coin, i.e. how much you bought
-		name = prod_id + '-USD'
-		stats = public_client.get_product_24hr_stats(name)
-		value = (float(stats['high']) + float(stats['low']))/2
-		allvar.append([prod_id, value, v])
-		sumvar += v
-	priority = sorted(allvar, key=lambda i: i[2])
-	portfolio = []
-	for i in priority:
-		investment = S_0*i[2]/sumvar
-		currency = investment/i[1]
-		portfolio.append((i[0], currency, investment)) # id, investment, currency
+	portfolio = plan_portfolio(S_0, params, method, paths) # id, currency, investment
 	print("\nYour suggested investments are: \n")
 	for coin in portfolio:
 		print("%s: %s for %s USD" % (coin[0], coin[1], coin[2]))
@@ -110,12 +212,7 @@ def generate_portfolio(S_0, params):
 		inp = input("\nWould you like to save this portfolio? (y/n)	")
 		try:
 			if inp.lower() == 'y':
-				public_client = gdax.PublicClient()
-				current_date = np.datetime64(public_client.get_time().get("iso").split('T')[0])
-				# Save the file
-				with open("portfolios/%s.txt" % (current_date), "w") as f:
-					for coin in portfolio:
-						f.write(str(coin[0]) + ', ' + str(coin[1]) + ', ' + str(coin[2]) + '\n')
+				save_portfolio(portfolio)
 				print("Portfolio saved. Exiting.\n")
 				done = True
 			if inp.lower() == 'n':
@@ -126,8 +223,49 @@ def generate_portfolio(S_0, params):
 
 
 if __name__ == "__main__":
-	prompt()
-	params = analyze()
+	import argparse
+	parser = argparse.ArgumentParser()
+	parser.add_argument(
+		"--batch",
+		nargs="*",
+		metavar="FILE",
+		help="Calibrate these call_data files (or all of them) in parallel without prompting"
+	)
+	parser.add_argument(
+		"--workers",
+		type=int,
+		default=None,
+		help="Number of worker processes for --batch"
+	)
+	parser.add_argument(
+		"--joint",
+		action="store_true",
+		help="With --batch, fit all the maturities of each coin together"
+	)
+	parser.add_argument(
+		"--offline",
+		action="store_true",
+		help="Price coins from the local candle store instead of the exchange"
+	)
+	parser.add_argument(
+		"--ttl",
+		type=float,
+		default=60.0,
+		help="Seconds a fetched quote is reused for"
+	)
+	parser.add_argument(
+		"--allocation",
+		choices=["mean-variance", "cvar"],
+		default="mean-variance",
+		help="Minimize the variance or the expected shortfall of the portfolio"
+	)
+	args = parser.parse_args()
+	quotes.service(args.ttl, args.offline)
+	if args.batch is None:
+		prompt()
+		params = analyze()
+	else:
+		params = analyze_batch(args.batch or None, args.workers, args.joint)
 	S_0 = invest()
-	generate_portfolio(S_0, params)
+	generate_portfolio(S_0, params, args.allocation)
 	
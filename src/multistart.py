@@ -0,0 +1,147 @@
+#!/usr/bin/env python3
+
+""" Multi-start calibration.
+	A single Levenberg-Marquardt run from THETA_0 often stalls in a poor
+	local minimum. Here the calibration starts from many thetas spread over
+	SAMPLE_LOWER to SAMPLE_UPPER by a Latin hypercube design, every one
+	satisfying the Feller condition 2 k v_bar > sigma^2. The starts run
+	concurrently in a process pool, a few iterations per round, each round
+	carrying on the damping of the one before. Once the starts have had
+	min_iter iterations, the live ones whose residual norm is far behind
+	the best live one are dropped after each round, so most of the work
+	goes into the promising ones. Starts that already stopped are not
+	compared against, since a start that stalls early in a local minimum
+	would otherwise end the ones still on their way to a better fit.
+"""
+
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+import time
+import numpy as np
+import analysis
+from instrument import NULL_TRACE
+
+# The box starting thetas are drawn from. v, v_bar and k are drawn
+# uniformly in log; sigma is drawn as a fraction of its Feller bound.
+SAMPLE_LOWER = np.array([1e-4, 1e-4, -0.95, 1e-3, 0.05])
+SAMPLE_UPPER = np.array([1.0, 1.0, 0.5, 5.0, 0.99])
+
+MultiStartResult = namedtuple('MultiStartResult',
+	['best', 'thetas', 'residual_norms', 'spread', 'starts', 'rounds', 'elapsed'])
+
+_data = None
+
+
+def latin_hypercube(n, d, seed=None):
+	""" n points in the unit d-cube, one in each of n equal slices of every
+		axis.
+	"""
+	rng = np.random.default_rng(seed)
+	return (np.argsort(rng.random((d, n)), axis=1).T + rng.random((n, d)))/n
+
+def starting_thetas(n, seed=None, lower=SAMPLE_LOWER, upper=SAMPLE_UPPER):
+	""" n starting thetas from a Latin hypercube. The last coordinate is the
+		fraction of sqrt(2 k v_bar) taken as sigma, so every start satisfies
+		the Feller condition.
+	"""
+	x = latin_hypercube(n, 5, seed)
+	theta = np.empty((n, 5))
+	for i in (0, 1, 3):
+		theta[:, i] = lower[i]*(upper[i]/lower[i])**x[:, i]
+	theta[:, 2] = lower[2] + x[:, 2]*(upper[2] - lower[2])
+	theta[:, 4] = (lower[4] + x[:, 4]*(upper[4] - lower[4]))*np.sqrt(2*theta[:, 3]*theta[:, 1])
+	return theta
+
+def _init(S_0_dat, K_dat, V_dat, T, kwargs):
+	# Each worker keeps the dataset, so rounds only send thetas
+	global _data
+	_data = (S_0_dat, K_dat, V_dat, T, kwargs)
+
+def _round(theta, iterations, mu, scale):
+	# iterations more from theta, continuing the damping mu and scale of
+	# the round before (None for the first). Returns the result and the
+	# damping to continue from.
+	S_0_dat, K_dat, V_dat, T, kwargs = _data
+	calibrator = analysis.HestonCalibrator(S_0_dat, K_dat, V_dat, T, theta0=theta, max_iter=iterations, **kwargs)
+	result = calibrator._calibrate(None, NULL_TRACE, theta, mu, scale)
+	return result, calibrator._mu, calibrator._scale
+
+def calibrate(S_0_dat, K_dat, V_dat, T, starts=8, round_iter=10, max_iter=200, min_iter=50,
+		prune=1e3, keep=0.75, rtol=0.05, workers=None, seed=None, thetas=None, **kwargs):
+	""" Calibrate from starts Latin hypercube thetas (or the given thetas)
+		and return a MultiStartResult.
+
+		Every round runs each live start round_iter iterations further (with
+		the damping carried over), up to max_iter in all. A start stops when
+		its calibration converges. Once the live starts have run min_iter
+		iterations, one is pruned when its residual norm is over prune times
+		the best of the live starts, or when it is outside the best keep
+		fraction of them. best is the CalibrationResult with the lowest
+		residual norm, and spread the standard deviation of the final thetas
+		within rtol of its norm. kwargs are passed on to
+		analysis.HestonCalibrator.
+	"""
+	start = time.perf_counter()
+	S_0_dat = np.asarray(S_0_dat, dtype=float)
+	K_dat = np.asarray(K_dat, dtype=float)
+	V_dat = np.asarray(V_dat, dtype=float)
+	if thetas is None:
+		thetas = starting_thetas(starts, seed)
+	thetas = np.array(thetas, dtype=float)
+	n = len(thetas)
+	results = [None]*n
+	norms = np.full(n, np.inf)
+	spent = np.zeros(n, dtype=int)
+	damping = [(None, None)]*n
+	live = np.arange(n)
+	rounds = 0
+	with ProcessPoolExecutor(max_workers=workers, initializer=_init,
+			initargs=(S_0_dat, K_dat, V_dat, T, kwargs)) as pool:
+		while len(live):
+			rounds += 1
+			iterations = [min(round_iter, max_iter - spent[i]) for i in live]
+			finished = []
+			mus, scales = zip(*(damping[i] for i in live))
+			for i, (result, mu, scale) in zip(live, pool.map(_round, thetas[live], iterations, mus, scales)):
+				spent[i] += result.iterations
+				damping[i] = mu, scale
+				if results[i] is not None:
+					# Carry the totals of the earlier rounds of this start
+					result = result._replace(iterations=spent[i], elapsed=result.elapsed + results[i].elapsed,
+						nfev=result.nfev + results[i].nfev, njev=result.njev + results[i].njev)
+				results[i] = result
+				thetas[i] = result.theta
+				norms[i] = result.residual_norm if np.isfinite(result.residual_norm) else np.inf
+				if result.stop_reason != 'max_iter' or spent[i] >= max_iter:
+					finished.append(i)
+			live = np.array([i for i in live if i not in finished], dtype=int)
+			if len(live) and spent[live].min() >= min_iter:
+				# Drop the starts hopelessly behind the best live one, and keep
+				# the best fraction of the rest
+				best = norms[live].min()
+				live = live[norms[live] <= prune*best]
+				live = live[np.argsort(norms[live], kind='stable')][:max(1, int(np.ceil(keep*len(live))))]
+	best = int(np.argmin(norms))
+	close = norms <= (1 + rtol)*norms[best]
+	return MultiStartResult(results[best], thetas, norms, thetas[close].std(axis=0), n, rounds,
+		time.perf_counter() - start)
+
+
+if __name__ == "__main__":
+	import argparse
+	parser = argparse.ArgumentParser()
+	parser.add_argument("paths", nargs="+", help="call_data files of one coin, fit together")
+	parser.add_argument("--starts", type=int, default=8, help="Number of starting thetas")
+	parser.add_argument("--round", type=int, default=10, help="Iterations per round")
+	parser.add_argument("--max-iter", type=int, default=200, help="Iterations per start in all")
+	parser.add_argument("--min-iter", type=int, default=50, help="Iterations per start before any is pruned")
+	parser.add_argument("--workers", type=int, default=None, help="Worker processes")
+	parser.add_argument("--seed", type=int, default=None)
+	args = parser.parse_args()
+	S_0_dat, K_dat, V_dat, T, coin = analysis.load_files(args.paths)
+	fit = calibrate(S_0_dat, K_dat, V_dat, T, args.starts, args.round, args.max_iter, args.min_iter,
+		workers=args.workers, seed=args.seed)
+	print("\n%s: best of %s starts after %s rounds in %.1f s" % (coin, fit.starts, fit.rounds, fit.elapsed))
+	print("Parameters: %s (%s)" % (fit.best.theta, analysis.STOP_REASONS[fit.best.stop_reason].replace("\n", " ")))
+	print("Residual norm: %s" % fit.best.residual_norm)
+	print("Spread of the starts within 5%% of it: %s" % fit.spread)
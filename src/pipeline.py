@@ -0,0 +1,247 @@
+#!/usr/bin/env python3
+
+""" The whole project, without prompts, for running unattended (e.g. from
+	cron). It runs four stages in order:
+
+		fetch      bring the candle history of each product up to date
+		dataset    build synthetic calls for every maturity from the candles,
+		           saved to pipeline_calls/ (one file per coin, replaced
+		           every run) and converted into the dataset store
+		calibrate  fit one term structure per coin through the calibration
+		           store, in parallel
+		portfolio  allocate the investment and save the portfolio
+
+	Settings come from DEFAULTS, then a JSON config file, then flags:
+		python3 src/pipeline.py --config pipeline.json --stages calibrate portfolio
+
+	Each finished stage is recorded in the state file with a key of the
+	settings and the input data it used. fetch runs on every invocation;
+	dataset keys on the candles of its products, calibrate on the contents
+	of the dataset store, and portfolio on the calibrations and the day. A
+	rerun skips stages whose key is unchanged, so a failed run picks up
+	where it stopped and a daily run redoes only what new candles changed;
+	--force runs them again. Network clients are only imported by the
+	stages that use them, and --offline skips fetching and prices coins
+	from the candle store.
+"""
+
+import glob
+import hashlib
+import importlib.util
+import json
+import os
+import time
+
+STAGES = ['fetch', 'dataset', 'calibrate', 'portfolio']
+
+DEFAULTS = {
+	'products': ['BTC-USD', 'ETH-USD', 'BCH-USD', 'LTC-USD'],
+	'maturities': [30, 60, 90],
+	'samples': 100, # calls per maturity, or null for every start date
+	'seed': 0,
+	'investment': 1000.0,
+	'allocation': 'mean-variance',
+	'workers': None,
+	'offline': False,
+	'candles': 'candles/',
+	'call_data': 'pipeline_calls/', # kept apart from the shipped call_data/
+	'dataset': 'datasets/',
+	'calibrations': 'calibrations/',
+	'portfolios': 'portfolios/',
+	'state': 'pipeline_state.json',
+}
+
+# The settings each stage depends on. Changing one reruns the stage.
+DEPENDS = {
+	'fetch': ['products', 'candles'],
+	'dataset': ['products', 'maturities', 'samples', 'seed', 'candles', 'call_data', 'dataset'],
+	'calibrate': ['dataset', 'calibrations'],
+	'portfolio': ['investment', 'allocation', 'portfolios'],
+}
+
+
+def load_config(path=None, overrides=None):
+	""" DEFAULTS updated by the JSON file at path and then overrides,
+		ignoring overrides that are None.
+	"""
+	config = dict(DEFAULTS)
+	if path is not None:
+		with open(path, 'r') as f:
+			config.update(json.load(f))
+	for key, value in (overrides or {}).items():
+		if value is not None:
+			config[key] = value
+	unknown = set(config) - set(DEFAULTS)
+	if unknown:
+		raise ValueError("Unknown settings: %s" % ", ".join(sorted(unknown)))
+	return config
+
+def _key(config, stage, inputs=None):
+	# A hash of the settings stage depends on and of its inputs
+	settings = json.dumps({k: config[k] for k in DEPENDS[stage]}, sort_keys=True)
+	digest = hashlib.sha1(settings.encode())
+	digest.update(json.dumps(inputs, sort_keys=True, default=str).encode())
+	return digest.hexdigest()[:16]
+
+
+class Pipeline:
+	""" Runs the stages with one config, keeping their results in the
+		state file.
+	"""
+
+	def __init__(self, config):
+		self.config = config
+		self.state = {}
+		if os.path.exists(config['state']):
+			with open(config['state'], 'r') as f:
+				self.state = json.load(f)
+
+	def _save_state(self):
+		tmp = self.config['state'] + '.tmp'
+		with open(tmp, 'w') as f:
+			json.dump(self.state, f, indent=1)
+		os.replace(tmp, self.config['state'])
+
+	def inputs(self, stage):
+		""" What the result of stage depends on besides the settings, or
+			None if it has to run every time. Checked just before the stage
+			runs, so it sees what the stages before it produced.
+		"""
+		if stage == 'fetch':
+			return None
+		if stage == 'dataset':
+			store = self._store()
+			candles = {}
+			for product_id in self.config['products']:
+				dates, prices = store.series(product_id)
+				candles[product_id] = [len(dates), str(dates[-1]) if len(dates) else None]
+			return candles
+		if stage == 'calibrate':
+			import dataset
+			if not os.path.exists(os.path.join(self.config['dataset'], 'index.json')):
+				return None
+			return dataset.Dataset(self.config['dataset']).fingerprint()
+		if stage == 'portfolio':
+			# Prices are quoted afresh, so the plan is redone every day
+			calibrations = self.state.get('calibrate', {}).get('key')
+			return [calibrations, time.strftime('%Y-%m-%d')]
+
+	def done(self, stage, inputs=None):
+		entry = self.state.get(stage)
+		return inputs is not None and entry is not None and entry['key'] == _key(self.config, stage, inputs)
+
+	def run(self, stages=STAGES, force=False):
+		""" Run stages in order, skipping any already done with the same
+			settings and inputs unless force. Returns the results of the
+			stages.
+		"""
+		for stage in STAGES:
+			if stage not in stages:
+				continue
+			inputs = self.inputs(stage)
+			if not force and self.done(stage, inputs):
+				print("%s: up to date" % stage)
+				continue
+			start = time.perf_counter()
+			result = getattr(self, stage)()
+			self.state[stage] = {
+				'key': _key(self.config, stage, self.inputs(stage) if inputs is None else inputs),
+				'finished': time.time(),
+				'seconds': time.perf_counter() - start,
+				'result': result,
+			}
+			self._save_state()
+			print("%s: done in %.1f s" % (stage, self.state[stage]['seconds']))
+		return {stage: self.state[stage]['result'] for stage in stages if stage in self.state}
+
+	def _store(self):
+		from candles import CandleStore
+		return CandleStore(self.config['candles'])
+
+	def fetch(self):
+		if self.config['offline']:
+			print("fetch: offline, using the stored candles")
+			return {}
+		store = self._store()
+		if importlib.util.find_spec('aiohttp') is None:
+			return {p: store.update(p) for p in self.config['products']}
+		return store.update_many(self.config['products'])
+
+	def dataset(self):
+		import dataset
+		from sample_calls import term_calls, write_calls
+		store = self._store()
+		paths = []
+		for product_id in self.config['products']:
+			dates, prices = store.series(product_id)
+			if len(dates) == 0:
+				print("dataset: no candles for %s, skipping it" % product_id)
+				continue
+			calls = term_calls(dates, prices, self.config['maturities'], self.config['samples'], self.config['seed'])
+			coin = product_id.split('-')[0]
+			os.makedirs(self.config['call_data'], exist_ok=True)
+			path = os.path.join(self.config['call_data'], "%s_%s_multi.csv" % (coin, dates[-1]))
+			write_calls(path, *calls)
+			# The coin's file of an earlier day holds the same calls, up to that day
+			for old in glob.glob(os.path.join(self.config['call_data'], "%s_*_multi.csv" % coin)):
+				if old != path:
+					os.remove(old)
+			paths.append(path)
+		if not paths:
+			raise RuntimeError("No candles for any of %s. Run the fetch stage first." % ", ".join(self.config['products']))
+		# Each coin's rows are rebuilt from this run's calls rather than added to
+		ds = dataset.convert(paths, self.config['dataset'], replace=True)
+		return {'files': paths, 'rows': len(ds)}
+
+	def calibrate(self):
+		from concurrent.futures import ProcessPoolExecutor
+		import dataset
+		coins = dataset.Dataset(self.config['dataset']).coins
+		with ProcessPoolExecutor(max_workers=self.config['workers']) as pool:
+			records = list(pool.map(calibrate_coin, coins, [self.config['dataset']]*len(coins), [self.config['calibrations']]*len(coins)))
+		for record in records:
+			print("calibrate: %s theta = %s (%s)" % (record['coin'], record['theta'], record['stop_reason']))
+		return records
+
+	def portfolio(self):
+		import numpy as np
+		import main, quotes
+		if 'calibrate' not in self.state:
+			raise RuntimeError("Nothing has been calibrated yet. Run the calibrate stage first.")
+		quotes.service(offline=self.config['offline'], store=self._store())
+		params = [[np.array(rec['theta']), np.array(rec['maturities']), rec['coin']] for rec in self.state['calibrate']['result']]
+		portfolio = main.plan_portfolio(self.config['investment'], params, self.config['allocation'], store=self._store())
+		for coin in portfolio:
+			print("portfolio: %s: %s for %s USD" % coin)
+		return {'path': main.save_portfolio(portfolio, self.config['portfolios']), 'portfolio': [list(coin) for coin in portfolio]}
+
+
+def calibrate_coin(coin, dataset_dir='datasets/', store_dir='calibrations/'):
+	""" Calibrate every maturity of coin in the dataset store together,
+		through the calibration store. Runs in a worker process.
+	"""
+	import dataset
+	from calibration_store import CalibrationStore
+	S_0, K, V, T = dataset.Dataset(dataset_dir).calibration_data(coin)
+	record, cached = CalibrationStore(store_dir).calibrate(S_0, K, V, T, coin)
+	return record
+
+
+if __name__ == "__main__":
+	import argparse
+	parser = argparse.ArgumentParser()
+	parser.add_argument("--config", type=str, default=None, help="JSON file of settings")
+	parser.add_argument("--stages", nargs="+", choices=STAGES, default=STAGES, help="Stages to run")
+	parser.add_argument("--force", action="store_true", help="Rerun stages that are up to date")
+	parser.add_argument("--products", nargs="+", default=None, help="Products, e.g. BTC-USD ETH-USD")
+	parser.add_argument("--maturities", type=int, nargs="+", default=None, help="Maturities in days")
+	parser.add_argument("--samples", type=int, default=None, help="Calls per maturity")
+	parser.add_argument("--investment", type=float, default=None, help="USD to allocate")
+	parser.add_argument("--allocation", choices=["mean-variance", "cvar"], default=None)
+	parser.add_argument("--workers", type=int, default=None, help="Calibration worker processes")
+	parser.add_argument("--offline", action="store_true", default=None, help="Never touch the network")
+	parser.add_argument("--state", type=str, default=None, help="State file recording finished stages")
+	args = parser.parse_args()
+	overrides = {k: v for k, v in vars(args).items() if k not in ('config', 'stages', 'force')}
+	config = load_config(args.config, overrides)
+	Pipeline(config).run(args.stages, args.force)
@@ -1,10 +1,23 @@
 #!/usr/bin/env python3
 
-""" This script has two functions: 1. prompt the user for a time frame to 
+""" This script has two functions: 1. prompt the user for a time frame to
 	consider and an initial investment. 2. Use the results from analysis.py to
 	construct an optimial investment plan.
+
+	Plans are long-only allocations of the whole investment, found by
+	projected gradient descent (with Nesterov acceleration and a
+	backtracking step) onto the simplex of weights. Two objectives are
+	available:
+		* mean-variance, from expected returns and a covariance matrix,
+		  either estimated from a matrix of returns or implied by the
+		  calibrated Heston parameters
+		* conditional value at risk (expected shortfall) of a matrix of
+		  simulated or historical returns, smoothed so it is differentiable
+	Every step is a matrix product, so thousands of coins take seconds.
 """
 
+import numpy as np
+
 def prompt():
 	done = False
 	while done != True:
@@ -15,3 +28,155 @@ def prompt():
 		except Exception:
 			print("Unable to convert to suitable format. Please try again.")
 	return S_0
+
+###########################################################################
+
+def project_simplex(w):
+	""" The closest point to w with non-negative weights summing to one.
+	"""
+	u = np.sort(w)[::-1]
+	css = np.cumsum(u) - 1
+	ind = np.arange(1, len(w) + 1)
+	rho = np.nonzero(u - css/ind > 0)[0][-1]
+	return np.maximum(w - css[rho]/(rho + 1), 0)
+
+def projected_gradient(f, x0, project, max_iter=5000, tol=1e-9, value=None):
+	""" Minimize f, which returns the value and gradient at x, over the set
+		project() maps onto, starting from x0. Accelerated (FISTA) with a
+		backtracking estimate of the Lipschitz constant. value, if given,
+		returns only the value of f, for the line search.
+	"""
+	if value is None:
+		value = lambda x: f(x)[0]
+	x = project(x0)
+	y = x.copy()
+	t = 1.0
+	L = 1.0
+	fx = value(x)
+	for i in range(max_iter):
+		fy, gy = f(y)
+		while True:
+			x_new = project(y - gy/L)
+			diff = x_new - y
+			f_new = value(x_new)
+			if f_new <= fy + gy @ diff + L/2*diff @ diff or L > 1e300:
+				break
+			L *= 2
+		step = np.max(np.abs(x_new - x))
+		if step <= tol:
+			break
+		if f_new > fx:
+			if t == 1.0:
+				# Even a plain gradient step fails: f is at its rounding floor
+				break
+			# Restart the momentum when it stops paying off
+			y, t = x.copy(), 1.0
+			continue
+		t_new = (1 + np.sqrt(1 + 4*t**2))/2
+		y = x_new + (t - 1)/t_new*(x_new - x)
+		x, fx, t = x_new, f_new, t_new
+	return x
+
+def moments(returns):
+	""" The mean and covariance of the columns of a return matrix.
+	"""
+	returns = np.asarray(returns, dtype=float)
+	return returns.mean(axis=0), np.cov(returns, rowvar=False).reshape(returns.shape[1], returns.shape[1])
+
+def candle_returns(store, product_ids, horizon=1):
+	""" The log returns over horizon days of each product, one column each,
+		on the dates every product has a candle for in the candle store.
+	"""
+	series = [store.series(p) for p in product_ids]
+	dates = series[0][0]
+	for known, prices in series[1:]:
+		dates = np.intersect1d(dates, known)
+	prices = np.column_stack([prices[np.searchsorted(known, dates)] for known, prices in series])
+	return np.log(prices[horizon:]/prices[:-horizon])
+
+def heston_covariance(thetas, T, corr=None):
+	""" The covariance of the log returns of coins over T days implied by
+		their Heston parameters: the expected integrated variance of each,
+		coupled by the correlation matrix corr (independent by default).
+	"""
+	thetas = np.atleast_2d(np.asarray(thetas, dtype=float))
+	v, v_bar, rho, k, sigma = thetas.T
+	var = v_bar*T + (v - v_bar)*(-np.expm1(-k*T))/k
+	sd = np.sqrt(np.maximum(var, 0))
+	corr = np.eye(len(thetas)) if corr is None else np.asarray(corr, dtype=float)
+	return corr*np.outer(sd, sd)
+
+def mean_variance(mean, cov, risk_aversion=1.0, w0=None, max_iter=5000, tol=1e-9):
+	""" The long-only weights maximizing mean.w - risk_aversion/2 w.cov.w.
+		With no expected returns this is the minimum variance portfolio.
+	"""
+	mean = np.asarray(mean, dtype=float)
+	cov = np.asarray(cov, dtype=float)
+	n = len(mean)
+	# Scale the objective so the step search starts near the right size
+	scale = max(np.max(np.abs(np.diag(cov)))*risk_aversion, np.max(np.abs(mean)), 1e-300)
+
+	def f(w):
+		cw = cov @ w
+		return (risk_aversion/2*w @ cw - mean @ w)/scale, (risk_aversion*cw - mean)/scale
+
+	w0 = np.full(n, 1/n) if w0 is None else w0
+	return projected_gradient(f, w0, project_simplex, max_iter, tol)
+
+def cvar(returns, alpha=0.05, return_weight=0.0, smoothing=None, w0=None, max_iter=200, tol=1e-7):
+	""" The long-only weights minimizing the conditional value at risk at
+		level alpha (the average loss in the worst alpha of the scenarios
+		in the rows of returns), less return_weight times the mean return.
+		This is Rockafellar and Uryasev's formulation, with the hinge
+		max(loss - zeta, 0) smoothed over a width of smoothing. The width
+		starts a thousand times larger and is narrowed tenfold at a time,
+		warm starting each stage, since the sharp problem alone converges
+		slowly. max_iter and tol apply to each stage.
+	"""
+	R = np.asarray(returns, dtype=float)
+	N, n = R.shape
+	if smoothing is None:
+		smoothing = 1e-3*max(np.std(R), 1e-12)
+	mean = R.mean(axis=0)
+	scale = max(np.max(np.std(R, axis=0)), 1e-300)
+
+	def objective(width):
+		def hinge(z):
+			# softplus, written to avoid overflow
+			return width*(np.maximum(z, 0) + np.log1p(np.exp(-np.abs(z))))
+
+		def value(x):
+			w, zeta = x[:-1], x[-1]
+			z = -(R @ w + zeta)/width
+			return (zeta + hinge(z).sum()/(alpha*N) - return_weight*(mean @ w))/scale
+
+		def f(x):
+			w, zeta = x[:-1], x[-1]
+			z = -(R @ w + zeta)/width
+			p = np.exp(-np.logaddexp(0, -z))
+			grad_w = -(p @ R)/(alpha*N) - return_weight*mean
+			grad_zeta = 1 - p.sum()/(alpha*N)
+			f_x = zeta + hinge(z).sum()/(alpha*N) - return_weight*(mean @ w)
+			return f_x/scale, np.append(grad_w, grad_zeta)/scale
+		return f, value
+
+	def project(x):
+		return np.append(project_simplex(x[:-1]), x[-1])
+
+	w0 = np.full(n, 1/n) if w0 is None else w0
+	# Start zeta at the value at risk of the starting weights
+	x = np.append(w0, -np.quantile(R @ w0, alpha))
+	for width in smoothing*10.0**np.arange(3, -1, -1):
+		f, value = objective(width)
+		x = projected_gradient(f, x, project, max_iter, tol, value)
+	return x[:-1]
+
+def allocate(S_0, ids, prices, weights):
+	""" Split an investment of S_0 USD by weights. Returns the (id,
+		currency, investment) of each coin, smallest investment first.
+	"""
+	portfolio = []
+	for i in np.argsort(weights, kind='stable'):
+		investment = S_0*weights[i]
+		portfolio.append((ids[i], investment/prices[i], investment))
+	return portfolio
@@ -4,9 +4,9 @@
 """
 
 import os
+import quotes
 
 def check():
-	import gdax
 	done = False
 	while done != True:
 		# Display the current portfolios
@@ -29,14 +29,13 @@ def check():
 					investments.append((prod_id, currency, S_0))
 		except ValueError:
 			print("Your input could not be interpreted")
-		pc = gdax.PublicClient()
+		# Quotes are shared and cached, so checking again soon is free
+		prices = quotes.service().mids(i[0] + '-USD' for i in investments)
 		profit = 0
 		for i in investments:
-			name = i[0] + '-USD'
-			stats = pc.get_product_24hr_stats(name)
 			S_0 = i[2]
 			currency = i[1]
-			S_t = (float(stats['high']) + float(stats['low']))/2
+			S_t = prices[i[0] + '-USD']
 			print("Your investment in %s at %s USD is now worth %s" % (i[0], S_0, S_t*currency))
 			profit += S_t*currency - S_0
 		print("\nYour total profit/loss for this portfolio:", profit) 
@@ -52,4 +51,13 @@ def check():
 
 
 if __name__ == "__main__":
+	import argparse
+	parser = argparse.ArgumentParser()
+	parser.add_argument(
+		"--offline",
+		action="store_true",
+		help="Price coins from the local candle store instead of the exchange"
+	)
+	args = parser.parse_args()
+	quotes.service(offline=args.offline)
 	check()
@@ -0,0 +1,193 @@
+#!/usr/bin/env python3
+
+""" Numerical integration of the pricing integral in analysis.py.
+	A Quadrature object chooses the nodes u at which the characteristic
+	function is evaluated, and the weights used to sum the integrand. The
+	same object is used by the pricer and the Jacobian, so both integrate
+	over the same nodes.
+
+	Available rules:
+		legacy: the original ten step trapezoid over u in [0.1, N]
+		laguerre: Gauss-Laguerre on [0, infinity), scaled to end at upper
+		legendre: Gauss-Legendre on the truncated domain [0, upper]
+		simpson: adaptive Simpson on [lower, upper]
+"""
+
+from functools import lru_cache
+import numpy as np
+
+RULES = ('legacy', 'laguerre', 'legendre', 'simpson')
+
+
+def _trapezoid(u, scale=1.0):
+	# Trapezoid weights for the (possibly uneven) nodes u
+	du = np.diff(u)*scale
+	w = np.zeros(len(u))
+	w[:-1] += du/2
+	w[1:] += du/2
+	return w
+
+@lru_cache(maxsize=64)
+def rule(name, n, upper=100.0, lower=1e-6):
+	""" The nodes and weights of a fixed rule with n nodes (n + 1 for
+		legacy). Results are cached per rule and are read-only.
+	"""
+	if name == 'legacy':
+		# The first node is shifted from 0 to 0.1 since the integrand is
+		# singular there, and each step is scaled by 1/N.
+		u = np.arange(n + 1, dtype=float)
+		u[0] = 0.1
+		w = _trapezoid(u, 1/n)
+	elif name == 'laguerre':
+		# Scaled so the largest node sits at upper, where the integrand has
+		# long since decayed but the characteristic function does not overflow
+		x, w = np.polynomial.laguerre.laggauss(n)
+		c = upper/x[-1]
+		u, w = c*x, c*w*np.exp(x)
+	elif name == 'legendre':
+		x, w = np.polynomial.legendre.leggauss(n)
+		u, w = (x + 1)*upper/2, w*upper/2
+	elif name == 'simpson':
+		u = np.linspace(lower, upper, 2*(n//2) + 1)
+		w = np.full(len(u), 2.0)
+		w[1::2] = 4.0
+		w[0] = w[-1] = 1.0
+		w *= (u[1] - u[0])/3
+	else:
+		raise ValueError("Unknown quadrature rule %r. Choose from %s." % (name, RULES))
+	u.flags.writeable = False
+	w.flags.writeable = False
+	return u, w
+
+def _coarse(name, n, upper, lower):
+	# A cheaper companion rule used to estimate the error of rule(name, n)
+	if name == 'legacy':
+		u, w = rule(name, n)
+		idx = np.unique(np.r_[0:len(u):2, len(u) - 1])
+		return u[idx], _trapezoid(u[idx], 1/n), 3.0
+	u, w = rule(name, max(n//2, 2), upper, lower)
+	return u, w, 1.0
+
+
+class Quadrature:
+	""" A quadrature rule for the pricing integral.
+		With tol set, integrate() doubles the number of nodes until the
+		estimated error of every price is below tol, and keeps that number
+		of nodes for later calls (including the Jacobian through nodes()).
+		evals counts the nodes at which the integrand has been evaluated.
+	"""
+
+	def __init__(self, rule='legacy', n=None, upper=100.0, lower=1e-6, tol=None, max_n=1024):
+		if rule not in RULES:
+			raise ValueError("Unknown quadrature rule %r. Choose from %s." % (rule, RULES))
+		self.rule = rule
+		self.n = n if n is not None else (10 if rule == 'legacy' else 32)
+		self.upper = upper
+		self.lower = lower
+		self.tol = tol
+		self.max_n = max_n
+		if rule == 'laguerre':
+			# Beyond this the Laguerre weights underflow and exp(x) overflows
+			self.max_n = min(max_n, 128)
+		self.evals = 0
+		self._nodes = None
+		self._panels = None
+
+	def nodes(self):
+		""" The current nodes and weights.
+		"""
+		if self._nodes is not None:
+			return self._nodes
+		return rule(self.rule, self.n, self.upper, self.lower)
+
+	def integrate(self, f, estimate=True):
+		""" Integrate f, a function of the node array u returning an array
+			whose last axis runs over u. Returns the integral and an
+			estimate of its absolute error, both with f's leading shape.
+			Without tol, estimate=False skips the error estimate (returning
+			None for it) and evaluates f only at the nodes.
+		"""
+		if self.rule == 'simpson' and self.tol is not None:
+			return self._adaptive_simpson(f)
+		while True:
+			u, w = rule(self.rule, self.n, self.upper, self.lower)
+			fu = f(u)
+			value = fu @ w
+			if self.tol is None and not estimate:
+				self.evals += len(u)
+				return value, None
+			u_c, w_c, factor = _coarse(self.rule, self.n, self.upper, self.lower)
+			if self.rule == 'legacy':
+				# The coarse nodes are a subset of the fine ones
+				fc = fu[..., np.searchsorted(u, u_c)]
+				self.evals += len(u)
+			else:
+				fc = f(u_c)
+				self.evals += len(u) + len(u_c)
+			err = np.abs(value - fc @ w_c)/factor
+			if self.tol is None or self.rule == 'legacy' or np.max(err) <= self.tol or 2*self.n > self.max_n:
+				return value, err
+			self.n *= 2
+
+	def _adaptive_simpson(self, f):
+		""" Adaptive Simpson over panels of [lower, upper]. Panels whose
+			worst-case error exceeds their share of tol are bisected. The
+			accepted panels are kept as the starting point of the next call
+			and as the node set returned by nodes(). The error estimate also
+			counts the piece [0, lower] left out of the integral, as lower
+			times |f(lower)|, which no refinement reduces.
+		"""
+		width = self.upper - self.lower
+		if self._panels is None:
+			edges = np.linspace(self.lower, self.upper, max(self.n//4, 1) + 1)
+			self._panels = edges[:-1], edges[1:]
+		a, b = self._panels
+		u = np.unique(np.concatenate((a, (a + b)/2, b)))
+		fu = f(u)
+		self.evals += len(u)
+		fa, fm, fb = (fu[..., np.searchsorted(u, x)] for x in (a, (a + b)/2, b))
+		done_a, done_b, done_val, done_err = [], [], [], []
+		n_done = 0
+		for depth in range(50):
+			h = b - a
+			fl, fr = f(a + h/4), f(b - h/4)
+			self.evals += 2*len(a)
+			whole = h/6*(fa + 4*fm + fb)
+			halves = h/12*(fa + 4*fl + 2*fm + 4*fr + fb)
+			err = np.abs(halves - whole)/15
+			ok = np.max(err.reshape(-1, len(a)), axis=0) <= self.tol*h/width
+			if 4*(n_done + 2*len(a)) > self.max_n:
+				ok[:] = True
+			n_done += np.count_nonzero(ok)
+			done_a.append(a[ok])
+			done_b.append(b[ok])
+			done_val.append(halves[..., ok].sum(axis=-1))
+			done_err.append(err[..., ok].sum(axis=-1))
+			if ok.all():
+				break
+			# Split the remaining panels in two
+			keep = ~ok
+			m = (a + b)/2
+			a, b = np.concatenate((a[keep], m[keep])), np.concatenate((m[keep], b[keep]))
+			fa, fm, fb = (np.concatenate(x, axis=-1) for x in ((fa[..., keep], fm[..., keep]),
+				(fl[..., keep], fr[..., keep]), (fm[..., keep], fb[..., keep])))
+		a, b = np.concatenate(done_a), np.concatenate(done_b)
+		order = np.argsort(a)
+		self._panels = a[order], b[order]
+		self._nodes = self._simpson_nodes(*self._panels)
+		self.n = len(self._nodes[0])
+		# The integrand is of order S_0 near u = 0, so the truncated piece
+		# is about lower*|f(lower)|
+		truncated = self.lower*np.abs(fu[..., 0])
+		return sum(done_val), sum(done_err) + truncated
+
+	@staticmethod
+	def _simpson_nodes(a, b):
+		# Composite Simpson nodes and weights on the halves of each panel
+		h = b - a
+		u = (a[:, None] + h[:, None]*np.array([0, 0.25, 0.5, 0.75, 1])).ravel()
+		w = (h[:, None]/12*np.array([1, 4, 2, 4, 1])).ravel()
+		u, idx = np.unique(u, return_inverse=True)
+		w_u = np.zeros(len(u))
+		np.add.at(w_u, idx, w)
+		return u, w_u
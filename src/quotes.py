@@ -0,0 +1,150 @@
+#!/usr/bin/env python3
+
+""" A shared source of current prices.
+	The price of a coin is the mid of its 24 hour high and low, as the rest
+	of the project has always estimated it. Quotes for many products are
+	fetched together (concurrently through fetch.AsyncPublicClient when
+	aiohttp is installed) and cached for ttl seconds, so asking for the same
+	coin again within a session does not touch the network.
+
+	Offline, or when a request fails, prices come from the last stored
+	candle in the local candle store instead.
+"""
+
+import importlib.util
+import time
+import numpy as np
+from candles import CandleStore, FIELDS
+
+_service = None
+
+
+class QuoteService:
+	""" Mid prices by product id, cached for ttl seconds. client is a
+		gdax.PublicClient-like client to fetch with one product at a time;
+		without one, quotes are fetched concurrently if aiohttp is installed
+		and through a gdax.PublicClient otherwise. With offline set, or for
+		products whose request fails, the candle store is used. source
+		records where each cached quote came from.
+	"""
+
+	def __init__(self, ttl=60.0, client=None, offline=False, store=None):
+		self.ttl = ttl
+		self.client = client
+		self.offline = offline
+		self.store = store if store is not None else CandleStore()
+		self.source = {}
+		self._quotes = {}
+		self._date = None
+
+	def _fresh(self, entry):
+		return entry is not None and time.monotonic() - entry[0] <= self.ttl
+
+	def _client(self):
+		if self.client is None:
+			import gdax
+			self.client = gdax.PublicClient()
+		return self.client
+
+	def _async(self):
+		# Fetch concurrently unless a client was given or aiohttp is missing
+		return self.client is None and importlib.util.find_spec('aiohttp') is not None
+
+	def _fetch(self, product_ids):
+		# The 24hr stats of each product, or the exception its request raised
+		if self._async():
+			from fetch import AsyncPublicClient, run
+
+			async def fetch_all():
+				async with AsyncPublicClient() as client:
+					return await client.gather(_attempt(client.get_product_24hr_stats(p)) for p in product_ids)
+
+			return run(fetch_all())
+		stats = []
+		for product_id in product_ids:
+			try:
+				stats.append(self._client().get_product_24hr_stats(product_id))
+			except Exception as e:
+				stats.append(e)
+		return stats
+
+	def _time(self):
+		if self._async():
+			from fetch import AsyncPublicClient, run
+
+			async def get_time():
+				async with AsyncPublicClient() as client:
+					return await client.get_time()
+
+			return run(get_time())
+		return self._client().get_time()
+
+	def _from_candles(self, product_id):
+		candles = self.store.load(product_id)
+		if len(candles) == 0:
+			raise RuntimeError("No quote for %s: it is not in the candle store." % product_id)
+		last = candles[-1]
+		return float(last[FIELDS.index('high')] + last[FIELDS.index('low')])/2
+
+	def mids(self, product_ids):
+		""" The current price of each of product_ids, as a dict. Only those
+			not cached within ttl are looked up, all in one batch.
+		"""
+		product_ids = list(product_ids)
+		missing = [p for p in dict.fromkeys(product_ids) if not self._fresh(self._quotes.get(p))]
+		stats = [None]*len(missing) if self.offline else self._fetch(missing)
+		for product_id, stat in zip(missing, stats):
+			if isinstance(stat, dict) and 'high' in stat and 'low' in stat:
+				price, source = (float(stat['high']) + float(stat['low']))/2, 'exchange'
+			else:
+				price, source = self._from_candles(product_id), 'candles'
+			self._quotes[product_id] = (time.monotonic(), price)
+			self.source[product_id] = source
+		return {p: self._quotes[p][1] for p in product_ids}
+
+	def mid(self, product_id):
+		return self.mids([product_id])[product_id]
+
+	def server_date(self):
+		""" The exchange's current date, or the local one offline.
+		"""
+		if not self._fresh(self._date):
+			date = None
+			if not self.offline:
+				try:
+					date = np.datetime64(self._time().get("iso").split('T')[0])
+				except Exception:
+					pass
+			if date is None:
+				date = np.datetime64('today', 'D')
+			self._date = (time.monotonic(), date)
+		return self._date[1]
+
+	def clear(self):
+		self._quotes.clear()
+		self.source.clear()
+		self._date = None
+
+
+async def _attempt(coro):
+	# The result of coro, or the exception it raised
+	try:
+		return await coro
+	except Exception as e:
+		return e
+
+
+def service(ttl=None, offline=None, store=None):
+	""" The quote service shared by every part of the program. ttl, offline
+		and the candle store, if given, change its settings.
+	"""
+	global _service
+	if _service is None:
+		_service = QuoteService()
+	if ttl is not None:
+		_service.ttl = ttl
+	if offline is not None:
+		_service.offline = offline
+	if store is not None:
+		_service.store = store
+	return _service
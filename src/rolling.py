@@ -0,0 +1,208 @@
+#!/usr/bin/env python3
+
+""" Rolling recalibration, for parameters that track the market day by day.
+	The dataset is a sliding window of synthetic calls: a call started on
+	date d with maturity T is known once the price on d + T is, and it is
+	kept while d + T is within the last `window` days. Each new daily
+	candle adds the calls maturing that day and drops the ones that left
+	the window.
+
+	The calibration of each day is warm-started from the theta of the day
+	before. The residues and Jacobian rows of the calls still in the window
+	were computed at that theta at the end of the previous calibration and
+	are kept, so the first iteration only evaluates the new calls. Small
+	daily moves of the window usually converge in a few iterations.
+
+	The window, theta and cached rows of each coin are saved to
+	rolling/COIN.npz, so the updates can run as separate processes, e.g.
+	once a day from cron.
+"""
+
+import os
+import numpy as np
+import analysis
+from analysis import HestonCalibrator
+from instrument import NULL_TRACE
+from sample_calls import term_calls
+
+
+class RollingCalibrator(HestonCalibrator):
+	""" A HestonCalibrator over a sliding window of calls with the given
+		maturities (in days), advanced one day at a time by advance().
+		Keywords are those of HestonCalibrator.
+	"""
+
+	def __init__(self, maturities, window=365, **kwargs):
+		HestonCalibrator.__init__(self, [], [], [], np.zeros(0, dtype=int), **kwargs)
+		self.maturities = np.atleast_1d(np.asarray(maturities, dtype=int))
+		self.window = window
+		self.date = np.zeros(0, dtype='datetime64[D]') # start date of each call
+		self.last = None # the newest day in the window
+		# Residues and Jacobian rows of the calls, valid for the rows marked
+		# fresh, at theta rows_at
+		self.rows_at = None
+		self._res = np.zeros(0)
+		self._J = np.zeros((5, 0))
+		self._fresh = np.zeros(0, dtype=bool)
+
+	def __len__(self):
+		return len(self.K_dat)
+
+	def __getstate__(self):
+		# Unlike a plain calibrator's, the cached rows are part of the state
+		state = HestonCalibrator.__getstate__(self)
+		state['_res'], state['_J'] = self._res, self._J
+		return state
+
+	def advance(self, dates, prices, day=None):
+		""" Move the window to day (by default the last of dates), adding
+			the calls that matured since the last advance and dropping those
+			that left the window. dates and prices are the daily price
+			series, e.g. from CandleStore.series(). Returns the number of
+			calls added and dropped.
+		"""
+		dates = np.asarray(dates, dtype='datetime64[D]')
+		prices = np.asarray(prices, dtype=float)
+		day = dates[-1] if day is None else np.datetime64(day, 'D')
+		first = day - self.window - self.maturities.max()
+		known = (dates >= first) & (dates <= day)
+		if not known.any():
+			raise ValueError("No prices between %s and %s." % (first, day))
+		date, S_0, K, V, T = term_calls(dates[known], prices[known], self.maturities)
+		due = date + T.astype('timedelta64[D]')
+		new = due > day - self.window
+		if self.last is not None:
+			new &= due > self.last
+		# Calls whose maturity date has left the window
+		keep = self.date + self.T.astype('timedelta64[D]') > day - self.window
+		self.date = np.concatenate([self.date[keep], date[new]])
+		self.S_0_dat = np.concatenate([self.S_0_dat[keep], S_0[new]])
+		self.K_dat = np.concatenate([self.K_dat[keep], K[new]])
+		self.V_dat = np.concatenate([self.V_dat[keep], V[new]])
+		self.T = np.concatenate([self.T[keep], T[new]])
+		self._res = np.concatenate([self._res[keep], np.zeros(new.sum())])
+		self._J = np.concatenate([self._J[:, keep], np.zeros((5, new.sum()))], axis=1)
+		self._fresh = np.concatenate([self._fresh[keep], np.zeros(new.sum(), dtype=bool)])
+		self.last = day
+		return int(new.sum()), int((~keep).sum())
+
+	def _normal_equations(self, theta, trace, trial=False):
+		# At the theta of the cached rows only the stale rows are evaluated
+		if trial or self.rows_at is None or not np.array_equal(theta, self.rows_at):
+			F, A, g = HestonCalibrator._normal_equations(self, theta, trace, trial)
+		else:
+			rows = np.nonzero(~self._fresh)[0]
+			if len(rows):
+				with trace.phase('residues'):
+					misses = self.cache.misses
+					res = analysis.r(theta, self.S_0_dat[rows], self.K_dat[rows], self.V_dat[rows],
+						self.T[rows], self.cache, self.quad, self.kernel).ravel()
+				self._count(trace, misses)
+				with trace.phase('jacobian'):
+					misses = self.cache.misses
+					J = analysis.jac(theta, self.S_0_dat[rows], self.K_dat[rows], self.T[rows], self.cache, self.quad, self.kernel)
+				self._count(trace, misses)
+				trace.count('h', 2)
+				self._res[rows] = res
+				self._J[:, rows] = J
+			self._nfev += 1
+			self._njev += 1
+			F, A, g = self._res @ self._res/2, self._J @ self._J.T, self._J @ self._res
+		self.rows_at = np.array(theta, dtype=float)
+		self._fresh = np.ones(len(self), dtype=bool)
+		return F, A, g
+
+	def calibrate(self, callback=None, trace=None):
+		""" Calibrate the current window, warm-started from the theta the
+			cached rows were computed at, and return a CalibrationResult.
+		"""
+		if len(self) == 0:
+			raise ValueError("The window has no calls yet. Call advance() first.")
+		if self.rows_at is not None:
+			self.theta0 = self.rows_at
+		result = HestonCalibrator.calibrate(self, callback, trace)
+		if not np.array_equal(result.theta, self.rows_at):
+			# The fit stopped on ftol after a step whose Jacobian was never
+			# taken. Its residues are those of the last trial, so only the
+			# Jacobian is computed, and the next day starts from result.theta.
+			self._normal_equations(result.theta, NULL_TRACE if trace is None else trace, trial=True)
+		self.theta0 = self.rows_at
+		return result
+
+	def save(self, path):
+		""" Save the window, theta and cached rows to an .npz file.
+		"""
+		os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+		tmp = "%s.%s.tmp.npz" % (path[:-len('.npz')] if path.endswith('.npz') else path, os.getpid())
+		np.savez(tmp, maturities=self.maturities, window=self.window, date=self.date,
+			S_0=self.S_0_dat, K=self.K_dat, V=self.V_dat, T=self.T, res=self._res, J=self._J,
+			fresh=self._fresh, theta0=self.theta0, rows_at=np.full(5, np.nan) if self.rows_at is None else self.rows_at,
+			last=np.array([] if self.last is None else [self.last], dtype='datetime64[D]'))
+		os.replace(tmp, path)
+
+
+def load(path, **kwargs):
+	""" A RollingCalibrator saved by RollingCalibrator.save(). kwargs are
+		the settings of HestonCalibrator, which are not saved.
+	"""
+	with np.load(path) as state:
+		calibrator = RollingCalibrator(state['maturities'], int(state['window']), theta0=state['theta0'], **kwargs)
+		calibrator.date = state['date']
+		calibrator.S_0_dat, calibrator.K_dat, calibrator.V_dat = state['S_0'], state['K'], state['V']
+		calibrator.T = state['T']
+		calibrator._res, calibrator._J, calibrator._fresh = state['res'], state['J'], state['fresh']
+		if not np.isnan(state['rows_at']).any():
+			calibrator.rows_at = state['rows_at']
+		if len(state['last']):
+			calibrator.last = state['last'][0]
+	return calibrator
+
+def update(product_id, maturities=(30, 60, 90), window=365, directory='rolling/', store=None,
+		offline=False, callback=None, **kwargs):
+	""" Advance the rolling calibration of product_id through every day of
+		candles since its last update, one calibration per day, and save it.
+		A product without saved state starts from a full calibration of the
+		window ending on its last candle. Returns the (day, added, dropped,
+		CalibrationResult) of each day. callback(day, added, dropped, result)
+		is called after each.
+	"""
+	if store is None:
+		from candles import CandleStore
+		store = CandleStore()
+	if not offline:
+		store.update(product_id)
+	dates, prices = store.series(product_id)
+	path = os.path.join(directory, "%s.npz" % product_id.split('-')[0])
+	if os.path.exists(path):
+		calibrator = load(path, **kwargs)
+		days = dates[dates > calibrator.last]
+	else:
+		calibrator = RollingCalibrator(maturities, window, **kwargs)
+		days = dates[-1:]
+	results = []
+	for day in days:
+		added, dropped = calibrator.advance(dates, prices, day)
+		result = calibrator.calibrate()
+		results.append((day, added, dropped, result))
+		if callback is not None:
+			callback(day, added, dropped, result)
+	calibrator.save(path)
+	return results
+
+
+if __name__ == "__main__":
+	import argparse
+	parser = argparse.ArgumentParser()
+	parser.add_argument("--product", type=str, default="BTC-USD", help="Product, e.g. BTC-USD")
+	parser.add_argument("--maturities", type=int, nargs="+", default=[30, 60, 90], help="Maturities in days")
+	parser.add_argument("--window", type=int, default=365, help="Days of maturing calls in the window")
+	parser.add_argument("--directory", type=str, default="rolling/", help="Where the rolling state is saved")
+	parser.add_argument("--offline", action="store_true", help="Use the stored candles without updating them")
+	args = parser.parse_args()
+
+	def report(day, added, dropped, result):
+		print("%s: +%s -%s calls, %s iterations in %.2f s, theta = %s" % (day, added, dropped,
+			result.iterations, result.elapsed, result.theta))
+
+	if not update(args.product, args.maturities, args.window, args.directory, offline=args.offline, callback=report):
+		print("%s is up to date." % args.product)
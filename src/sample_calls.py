@@ -7,9 +7,8 @@
 """
 
 import numpy as np
-import gdax
-import time
 import os
+from candles import CandleStore
 
 global T
 global current_date, product_id, n
@@ -30,7 +29,7 @@ def prompt_samp():
 			print("Unable to select product ID")
 	done = False
 	while done != True:
-		inp2 = input('\nHow many points to sample?\nWarning: sampling time is approximately 6 points a minute to avoid overloading the server.\n')
+		inp2 = input('\nHow many points to sample?\n')
 		try:
 			n = int(inp2)
 			done = True
@@ -55,6 +54,23 @@ def prompt_samp():
 	return n, Cid, T
 
 
+def make_calls(store, product_id, random_dates, T):
+	""" Make call options starting on each of random_dates with maturity T
+		days, entirely from the local candle store.
+	"""
+	random_dates = np.sort(np.asarray(random_dates, dtype='datetime64[D]'))
+	# The initial price and the price at maturity
+	close_price = store.price_on(product_id, random_dates)
+	strike = store.price_on(product_id, random_dates + np.timedelta64(T, 'D'))
+	calls = []
+	for date, S_0, K in zip(random_dates, close_price, strike):
+		if np.isnan(S_0) or np.isnan(K):
+			print("No candle for %s. Skipping this point." % (date))
+			continue
+		# the value of the option
+		calls.append([str(date), float(S_0), float(K), float(K - S_0)])
+	return calls
+
 def random_calls():
 	""" Make call options out of historic price data with "maturity" T.
 		assume the value of the option is zero.
@@ -73,89 +89,77 @@ def random_calls():
 		random_date = np.datetime64(start_date) + np.random.choice(days_to_add, n, replace=False)
 		return random_date
 
-	def make_calls(random_dates):
-		# sample the random dates
-		calls = []
-		count = 0
-		n_rest = 3 # the number of points to rest after
-		sleep = 30 # the time to sleep in between sampling
-
-		# Sample the dates
-		runtime = int((n*sleep)/(n_rest*60))
-		if runtime > 1:
-			s = "s"
-		else:
-			s = ""
-		if n % n_rest == 0:
-			tot_cyc = n // n_rest
-		else:
-			tot_cyc = n // n_rest + 1
-		print('\nSampling dates on %s. Expected runtime: %s minute%s.\n' % (product_id.split('-')[0], runtime, s))
-		for date in random_dates:
-			# The initial price
-			sample = public_client.get_product_historic_rates(
-				start=date,
-				end=(np.datetime64(date) + np.timedelta64(1, 'D')),
-				granularity=86400,
-				product_id=product_id
-			)
-			# The price at maturity
-			s_date = date + np.timedelta64(T, 'D')
-			s_sample = public_client.get_product_historic_rates(
-				start=s_date,
-				end=(np.datetime64(s_date) + np.timedelta64(1, 'D')),
-				granularity=86400,
-				product_id=product_id
-			)
-			count += 1
-
-			try: # try to get the close price
-				close_price = sample[0][3]
-				strike = s_sample[0][3]
-				# the value of the option
-				v = strike - close_price
-				# Save the point
-				data = [str(date), close_price, strike, v]
-				print(data)
-				calls.append(data)
-				if count % n_rest == 0:
-					if n - count == 0:
-						break
-					print("\nSleeping for %s seconds." % (sleep))
-					print("Data points taken so far:", count,"\n%s left to take. Time remaining: %s seconds.\n" % (n - count, (tot_cyc - count/n_rest)*sleep))
-					time.sleep(sleep)	
-				if count % 100 == 0:
-					print("\nSleeping for 5 minutes.")
-					time.sleep(300)
-			except Exception:
-				print("Unable to take data point. Exiting.")
-				break
-			calls.sort()
-		return calls
-
-	# Do the thing
-	public_client = gdax.PublicClient()
-	current_date = np.datetime64(public_client.get_time().get("iso").split('T')[0])
-	# Try to read in start dates from C_dates.csv
-	try:
-		with open("C_dates.csv", "r") as f:
-			dates = f.readlines()
-			for point in dates:
-				if point.split(", ")[0] == product_id:
-					start_date = str(point.split(", ")[1].strip("\n"))
-	except Exception: # if there are not yet start dates
-		from start_date import start_date
-		start_date = start_date(product_id)
-		random_calls(n)
+	# Bring the local candle history up to date. Only the first run for a
+	# product downloads its whole history; after that it's a request or two.
+	store = CandleStore()
+	print('\nUpdating the candle history of %s.' % (product_id))
+	store.update(product_id)
+	dates, prices = store.series(product_id)
+	current_date = dates[-1]
+	# The history starts the day the product was listed
+	start_date = dates[0]
 	# make the random dates
 	random_dates = random_date_generator(start_date)
 	# Make calls from the random dates
-	calls = make_calls(random_dates)
+	calls = make_calls(store, product_id, random_dates, T)
 	# Save the calls to a data file with today's date and the maturity
 	with open("call_data/%s_%s_%s.csv" % (product_id.split('-')[0], str(current_date), str(T)), "w") as f:
 		for call in calls:
 			f.write(call[0] + ', ' + str(call[1]) + ', ' + str(call[2]) + ', ' + str(call[3]) + '\n')
 	
+def term_calls(dates, prices, maturities, n=None, seed=None):
+	""" Synthetic calls for every maturity in maturities and every start
+		date with a price on both the start date and at maturity, built at
+		once from a daily price series. With n, at most n calls are sampled
+		(by index) for each maturity. Returns the arrays
+			date, S_0, K, V, T
+		with one element per call, sorted by maturity and then date.
+	"""
+	dates = np.asarray(dates, dtype='datetime64[D]')
+	maturities = np.atleast_1d(np.asarray(maturities, dtype=int))
+	T_max = maturities.max()
+	# Lay the series out on a gapless daily grid, padded so every start date
+	# has a full window of T_max days after it
+	day = (dates - dates[0]).astype(int)
+	span = day[-1] + 1
+	series = np.full(span + T_max, np.nan)
+	series[day] = prices
+	windows = np.lib.stride_tricks.sliding_window_view(series, T_max + 1)[:span]
+	S_0 = np.broadcast_to(windows[:, :1], (span, len(maturities)))
+	K = windows[:, maturities]
+	valid = ~(np.isnan(S_0) | np.isnan(K))
+	if n is not None:
+		# Keep a random n of the valid start dates of each maturity
+		rng = np.random.default_rng(seed)
+		rank = np.where(valid, rng.random(valid.shape), np.inf).argsort(axis=0).argsort(axis=0)
+		valid &= rank < n
+	# Columns are maturities, so transposing orders the calls by maturity
+	start, which = np.nonzero(valid.T)[::-1]
+	return dates[0] + start, S_0[start, which], K[start, which], K[start, which] - S_0[start, which], maturities[which]
+
+def write_calls(path, date, S_0, K, V, T=None):
+	""" Save calls in the call_data format, with the maturity of each call
+		as a fifth column when T is given.
+	"""
+	columns = [np.asarray(date).astype(str), S_0, K, V] + ([T] if T is not None else [])
+	with open(path, "w") as f:
+		for row in zip(*columns):
+			f.write(', '.join(str(x) for x in row) + '\n')
+
+def multi_calls(product_id, maturities, n=None, store=None):
+	""" Make one dataset of calls on product_id for all of maturities from
+		its candle history, saved to call_data/COIN_DATE_multi.csv.
+	"""
+	if store is None:
+		store = CandleStore()
+	store.update(product_id)
+	dates, prices = store.series(product_id)
+	calls = term_calls(dates, prices, maturities, n)
+	path = "call_data/%s_%s_multi.csv" % (product_id.split('-')[0], str(dates[-1]))
+	write_calls(path, *calls)
+	print("Saved %s calls with maturities %s to %s." % (len(calls[0]), list(maturities), path))
+	return path
+
 ##############################################################################
 	
 
@@ -169,4 +173,27 @@ if __name__ == "__main__":
 		choices=set(("Coinbase", "Binance")),
 		help="Exchange to take data from"
 	)
-	random_calls()
+	parser.add_argument(
+		"--product",
+		type=str,
+		default=None,
+		help="Product to sample, e.g. BTC-USD (with --maturities)"
+	)
+	parser.add_argument(
+		"--maturities",
+		type=int,
+		nargs="+",
+		default=None,
+		help="Build one dataset for all of these maturities without prompting"
+	)
+	parser.add_argument(
+		"-n",
+		type=int,
+		default=None,
+		help="Calls to sample per maturity (default: every start date)"
+	)
+	args = parser.parse_args()
+	if args.maturities is None:
+		random_calls()
+	else:
+		multi_calls(args.product or 'BTC-USD', args.maturities, args.n)
@@ -0,0 +1,250 @@
+#!/usr/bin/env python3
+
+""" Monte Carlo simulation of coins under calibrated Heston parameters.
+	Paths are stepped with Andersen's quadratic-exponential (QE) scheme,
+	which samples the variance from a moment-matched distribution so it
+	stays non-negative for any theta, and integrates the log price with the
+	central (gamma_1 = gamma_2 = 1/2) discretization.
+
+	Each coin follows its own theta = [v, v_bar, rho, k, sigma], as returned
+	by analysis.LM, with t in days. The price shocks of different coins can
+	be correlated. Paths are simulated in chunks and only summary
+	statistics are kept, so memory does not grow with the number of paths:
+	a running mean and variance, and a fixed-bin histogram of the terminal
+	log return from which VaR and expected shortfall are read.
+"""
+
+from collections import namedtuple
+import numpy as np
+
+PSI_C = 1.5 # QE switches from the quadratic to the exponential sample above this
+
+Simulation = namedtuple('Simulation', ['coins', 'portfolio', 'paths'])
+
+
+class StreamingStats:
+	""" Statistics of the simple returns in each of ncols columns, updated
+		one chunk of log returns at a time. The histogram has bins uniform in
+		log return on [-lim, lim], plus one bin each for anything beyond.
+		The sum of the returns in each bin is kept too, so the expected
+		shortfall is exact up to the bin holding the VaR.
+	"""
+
+	def __init__(self, ncols, lim=2.0, bins=4000):
+		self.ncols = ncols
+		self.edges = np.linspace(-lim, lim, bins + 1)
+		self.n = 0
+		self.mean = np.zeros(ncols)
+		self.m2 = np.zeros(ncols)
+		self.counts = np.zeros((ncols, bins + 2))
+		self.sums = np.zeros((ncols, bins + 2))
+
+	def update(self, x):
+		""" Add an (n x ncols) chunk of log returns.
+		"""
+		x = np.asarray(x, dtype=float).reshape(-1, self.ncols)
+		ret = np.expm1(x)
+		n = len(ret)
+		if n == 0:
+			return
+		# Chan's pairwise update of the mean and sum of squared deviations
+		mean = ret.mean(axis=0)
+		m2 = ((ret - mean)**2).sum(axis=0)
+		delta = mean - self.mean
+		total = self.n + n
+		self.mean = self.mean + delta*n/total
+		self.m2 = self.m2 + m2 + delta**2*self.n*n/total
+		self.n = total
+		# Bin 0 is below -lim and the last bin above lim
+		nb = self.counts.shape[1]
+		idx = np.searchsorted(self.edges, x, side='right') + nb*np.arange(self.ncols)
+		self.counts += np.bincount(idx.ravel(), minlength=nb*self.ncols).reshape(self.ncols, nb)
+		self.sums += np.bincount(idx.ravel(), weights=ret.ravel(), minlength=nb*self.ncols).reshape(self.ncols, nb)
+
+	def merge(self, other):
+		""" Combine with the statistics of another set of paths.
+		"""
+		delta = other.mean - self.mean
+		total = self.n + other.n
+		if total:
+			self.mean = self.mean + delta*other.n/total
+			self.m2 = self.m2 + other.m2 + delta**2*self.n*other.n/total
+		self.n = total
+		self.counts += other.counts
+		self.sums += other.sums
+		return self
+
+	def variance(self):
+		return self.m2/max(self.n - 1, 1)
+
+	def quantile(self, q):
+		""" The q quantile of the simple return of each column, interpolated
+			within its histogram bin.
+		"""
+		cum = np.cumsum(self.counts, axis=1)
+		target = q*self.n
+		out = np.empty(self.ncols)
+		for j in range(self.ncols):
+			i = min(np.searchsorted(cum[j], target), len(self.edges))
+			if i == 0:
+				x = self.edges[0]
+			elif i == len(self.edges):
+				x = self.edges[-1]
+			else:
+				before = cum[j, i] - self.counts[j, i]
+				frac = (target - before)/self.counts[j, i] if self.counts[j, i] else 0.0
+				x = self.edges[i - 1] + frac*(self.edges[i] - self.edges[i - 1])
+			out[j] = np.expm1(x)
+		return out
+
+	def value_at_risk(self, alpha=0.05):
+		""" The loss, as a fraction of the starting value, exceeded with
+			probability alpha.
+		"""
+		return -self.quantile(alpha)
+
+	def expected_shortfall(self, alpha=0.05):
+		""" The average loss in the worst alpha of outcomes.
+		"""
+		cum = np.cumsum(self.counts, axis=1)
+		target = alpha*self.n
+		out = np.empty(self.ncols)
+		for j in range(self.ncols):
+			i = np.searchsorted(cum[j], target)
+			below = cum[j, i] - self.counts[j, i]
+			tail = self.sums[j, :i].sum()
+			if self.counts[j, i]:
+				# Part of the bin holding the quantile, at its average return
+				tail += (target - below)*self.sums[j, i]/self.counts[j, i]
+			out[j] = -tail/target
+		return out
+
+	def histogram(self, column=0):
+		""" The edges, as ratios S_T/S_0, and counts of the terminal
+			distribution of one column, without the two overflow bins.
+		"""
+		return np.exp(self.edges), self.counts[column, 1:-1]
+
+	def summary(self, alpha=0.05):
+		return {
+			'paths': self.n,
+			'mean': self.mean.tolist(),
+			'std': np.sqrt(self.variance()).tolist(),
+			'VaR': self.value_at_risk(alpha).tolist(),
+			'ES': self.expected_shortfall(alpha).tolist(),
+			'alpha': alpha,
+		}
+
+
+def _thetas(thetas):
+	# An (ncoins x 5) array of parameters from one theta or a list of them
+	thetas = np.atleast_2d(np.asarray(thetas, dtype=float))
+	if thetas.shape[1] != 5:
+		raise ValueError("Each theta must be [v, v_bar, rho, k, sigma].")
+	return thetas
+
+def qe_step(v, dt, v_bar, k, sigma, z, uniform):
+	""" The variance after one QE step of length dt from v. z is a standard
+		normal and uniform a uniform sample of the shape of v.
+	"""
+	ekt = np.exp(-k*dt)
+	one_minus = -np.expm1(-k*dt)
+	m = v_bar + (v - v_bar)*ekt
+	s2 = v*sigma**2*ekt/k*one_minus + v_bar*sigma**2/(2*k)*one_minus**2
+	psi = s2/np.maximum(m, 1e-300)**2
+	# Quadratic: a (b + z)^2 with a non-central chi square like shape
+	quad = psi <= PSI_C
+	inv = 2/np.where(quad, psi, 1.0)
+	b2 = inv - 1 + np.sqrt(inv*np.maximum(inv - 1, 0))
+	a = m/(1 + b2)
+	v_quad = a*(np.sqrt(b2) + z)**2
+	# Exponential: a point mass at zero and an exponential tail
+	p = (psi - 1)/(psi + 1)
+	beta = (1 - p)/np.maximum(m, 1e-300)
+	v_exp = np.where(uniform <= p, 0.0, np.log(np.maximum((1 - p)/np.maximum(1 - uniform, 1e-300), 1.0))/beta)
+	return np.where(quad, v_quad, v_exp)
+
+def terminal_chunks(thetas, T, n_paths, corr=None, steps_per_day=1, chunk=100000, seed=None, mu=0.0):
+	""" Generates (m x ncoins) chunks of terminal log returns log(S_T/S_0)
+		after T days, n_paths in total. corr is the correlation matrix of the
+		coins' price shocks (independent by default), mu the drift per day.
+	"""
+	thetas = _thetas(thetas)
+	ncoins = len(thetas)
+	v_0, v_bar, rho, k, sigma = thetas.T
+	if corr is None:
+		L = np.eye(ncoins)
+	else:
+		L = np.linalg.cholesky(np.asarray(corr, dtype=float))
+	rng = np.random.default_rng(seed)
+	steps = max(int(np.ceil(T*steps_per_day)), 1)
+	dt = T/steps
+	# The coefficients of the central discretization of log S
+	K0 = -rho*k*v_bar*dt/sigma
+	K1 = dt/2*(k*rho/sigma - 0.5) - rho/sigma
+	K2 = dt/2*(k*rho/sigma - 0.5) + rho/sigma
+	K3 = dt/2*(1 - rho**2)
+	done = 0
+	while done < n_paths:
+		m = min(chunk, n_paths - done)
+		v = np.broadcast_to(v_0, (m, ncoins)).copy()
+		x = np.zeros((m, ncoins))
+		for _ in range(steps):
+			v_next = qe_step(v, dt, v_bar, k, sigma, rng.standard_normal((m, ncoins)), rng.random((m, ncoins)))
+			z = rng.standard_normal((m, ncoins)) @ L.T
+			x += mu*dt + K0 + K1*v + K2*v_next + np.sqrt(K3*(v + v_next))*z
+			v = v_next
+		done += m
+		yield x
+
+def sample_returns(thetas, T, n_paths, **kwargs):
+	""" An (n_paths x ncoins) matrix of simulated simple returns over T
+		days, for when the paths themselves are needed. kwargs are those of
+		terminal_chunks().
+	"""
+	return np.expm1(np.concatenate(list(terminal_chunks(thetas, T, n_paths, **kwargs))))
+
+def simulate(thetas, T, n_paths, weights=None, corr=None, steps_per_day=1, chunk=100000,
+		seed=None, mu=0.0, bins=4000, lim=None):
+	""" Simulate n_paths of every coin over T days and return a Simulation
+		of StreamingStats: one column per coin, and the portfolio with the
+		given weights (fractions of the investment in each coin) if any.
+		Memory is bounded by chunk paths at a time. lim is the range of log
+		returns the histograms cover, by default twelve standard deviations
+		of the larger of v and v_bar.
+	"""
+	thetas = _thetas(thetas)
+	if lim is None:
+		lim = max(12*np.sqrt(np.max(thetas[:, :2])*T) + abs(mu)*T, 0.5)
+	coins = StreamingStats(len(thetas), lim, bins)
+	portfolio = None
+	if weights is not None:
+		weights = np.asarray(weights, dtype=float)
+		portfolio = StreamingStats(1, lim, bins)
+	for x in terminal_chunks(thetas, T, n_paths, corr, steps_per_day, chunk, seed, mu):
+		coins.update(x)
+		if portfolio is not None:
+			portfolio.update(np.log1p(np.expm1(x) @ weights))
+	return Simulation(coins, portfolio, n_paths)
+
+
+if __name__ == "__main__":
+	import argparse
+	import time
+	import analysis
+	parser = argparse.ArgumentParser()
+	parser.add_argument("--paths", type=int, default=1000000, help="Number of paths")
+	parser.add_argument("--days", type=float, default=90, help="Horizon in days")
+	parser.add_argument("--steps", type=int, default=1, help="Steps per day")
+	parser.add_argument("--chunk", type=int, default=100000, help="Paths simulated at once")
+	parser.add_argument("--alpha", type=float, default=0.05, help="Tail probability of VaR and ES")
+	parser.add_argument("--seed", type=int, default=None)
+	args = parser.parse_args()
+	S_0_dat, K_dat, V_dat, T, coin = analysis.load()
+	theta, T = analysis.LM(S_0_dat, K_dat, V_dat, T)
+	start = time.perf_counter()
+	sim = simulate(theta, args.days, args.paths, steps_per_day=args.steps, chunk=args.chunk, seed=args.seed)
+	summary = sim.coins.summary(args.alpha)
+	print("\nSimulated %s paths of %s over %s days in %.1f s" % (args.paths, coin, args.days, time.perf_counter() - start))
+	print("Mean return: %.4f, standard deviation: %.4f" % (summary['mean'][0], summary['std'][0]))
+	print("%s%% VaR: %.4f, expected shortfall: %.4f" % (100*args.alpha, summary['VaR'][0], summary['ES'][0]))
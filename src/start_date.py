@@ -1,66 +1,119 @@
 #!/usr/bin/env python3
 
 """ This script gets the first date a coin was available on Coinbase.
-	It saves these dates to a file `Cbase_dates.dat` for reference.
+	It saves these dates to `C_dates.csv` (next to this script) for
+	reference, and keeps them in a registry loaded once per process.
 """
 
 import os.path
-from time import sleep
 import numpy as np
-import gdax
+
+REGISTRY = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'C_dates.csv')
+WINDOW = 300 # days of candles requested per probe, the most Coinbase returns
+
+_registry = None
 
 
 ###########################################################################
 
-def start_date(product_id):
+def _client(public_client):
+	if public_client is None:
+		import gdax
+		public_client = gdax.PublicClient()
+	return public_client
+
+def start_date(product_id, public_client=None):
+	""" Find the listing date of product_id with an exponential search back
+		from today followed by a binary search, so it takes a number of
+		requests logarithmic in the age of the product.
+	"""
+	public_client = _client(public_client)
 	print("Finding start date for:",product_id)
 	# Let's get the current date of the GDAX server
 	current_date = np.datetime64(public_client.get_time().get("iso").split('T')[0])
 
-	# Now to find the start date
-	test_start = current_date 
-	test_end = current_date
-	test = np.zeros(300)
-	while len(test) == 300:
-		test_start -= np.timedelta64(300, 'D')
-		test = public_client.get_product_historic_rates(
-			start=test_start,
-			end=test_end,
+	probed = {}
+
+	def probe(date):
+		# The candles in the window starting at date, oldest first
+		if date in probed:
+			return probed[date]
+		candles = public_client.get_product_historic_rates(
+			start=date,
+			end=date + np.timedelta64(WINDOW - 1, 'D'),
 			granularity=86400,
 			product_id=product_id
 		)
-		test_end -= np.timedelta64(300, 'D')
-	# Calculate the start date based on when the loop ended
-	start_date = np.datetime64(test_start) + np.timedelta64(300 - len(test), 'D')
-
-	# Test to see if we got it right:
-	test = public_client.get_product_historic_rates(
-		start=np.datetime64(start_date) - 2,
-		end=np.datetime64(start_date) - 1,
-		granularity=86400,
-		product_id=product_id
-	)
-
-	if test == []:
-		print("\n`start_date.py` was successful. %s was first offered %s on Coinbase.\n" % (product_id, start_date))
-	else:
-		print("`start_date.py` was not successful.")
+		if isinstance(candles, dict):
+			raise RuntimeError("Unable to fetch candles for %s: %s" % (product_id, candles.get('message', candles)))
+		probed[date] = sorted(candles)
+		return probed[date]
 
+	# Step back 1, 2, 4, ... windows until one comes back empty
+	step = 1
+	hi = current_date - np.timedelta64(WINDOW - 1, 'D') # has candles
+	lo = hi
+	while True:
+		lo = current_date - np.timedelta64(step*WINDOW, 'D')
+		if not probe(lo):
+			break
+		hi = lo
+		step *= 2
+	# Now the window at lo is empty and the one at hi is not. Once they are
+	# at most a window apart, the window at hi starts before the listing date.
+	while hi - lo > np.timedelta64(WINDOW, 'D'):
+		mid = lo + (hi - lo)//2
+		if probe(mid):
+			hi = mid
+		else:
+			lo = mid
+	first = probe(hi)
+	start_date = np.datetime64(int(first[0][0]), 's').astype('datetime64[D]')
+	print("%s was first offered %s on Coinbase." % (product_id, start_date))
 	return start_date
 
+def load_registry(path=REGISTRY):
+	""" The listing dates saved in path, by product.
+	"""
+	dates = {}
+	if os.path.exists(path):
+		with open(path, 'r') as f:
+			for point in f.readlines():
+				if point.strip():
+					product_id, date = point.strip("\n").split(", ")
+					dates[product_id] = np.datetime64(date)
+	return dates
+
+def listing_dates(product_ids=(), public_client=None, path=REGISTRY):
+	""" The listing date of each of product_ids, from the registry. It is
+		read once per process, and products missing from it are looked up
+		with start_date() and appended to it.
+	"""
+	global _registry
+	if _registry is None:
+		_registry = load_registry(path)
+	missing = [p for p in product_ids if p not in _registry]
+	if missing:
+		public_client = _client(public_client)
+		with open(path, 'a') as f:
+			for product_id in missing:
+				date = start_date(product_id, public_client)
+				_registry[product_id] = date
+				f.write(product_id + ", " + str(date) + "\n")
+	return {p: _registry[p] for p in product_ids}
+
+def listing_date(product_id, public_client=None):
+	return listing_dates([product_id], public_client)[product_id]
+
 
 if __name__ == "__main__":
+	import gdax
 	# Start the Coinbase client
 	public_client = gdax.PublicClient()
 	# Get the available symbols
 	C_prices = public_client.get_products()
-	C_symbols = list(set(dic.get('id') for dic in C_prices))
-	
-	file = open("C_dates.csv", "w+")
-	for product_id in C_symbols:
-		# Let's only do coins in US Dollars
-		if product_id.split("-")[1] == 'USD':
-			date = start_date(product_id)
-			# Write the results to a file
-			file.write(product_id + ", " + str(date) + "\n")
-	file.close()
+	C_symbols = sorted(set(dic.get('id') for dic in C_prices))
+	# Let's only do coins in US Dollars
+	USD = [product_id for product_id in C_symbols if product_id.split("-")[1] == 'USD']
+	for product_id, date in listing_dates(USD, public_client).items():
+		print(product_id, date)
@@ -0,0 +1,85 @@
+""" The pricer and its Jacobian in analysis.py: the vectorized pricer
+	against the original per-node loop, the analytic Jacobian against finite
+	differences of the prices, and the kernel backends against each other.
+"""
+
+import numpy as np
+import pytest
+import analysis
+import kernels
+import quadrature
+
+THETA = np.array([0.002, 0.003, -0.5, 0.05, 0.02])
+
+
+def dataset(ndat=40, seed=0, T=90):
+	rng = np.random.default_rng(seed)
+	S_0 = rng.uniform(100, 400, ndat)
+	K = S_0*rng.uniform(0.7, 1.3, ndat)
+	if T is None:
+		T = rng.choice([30, 60, 90, 180], ndat)
+	return S_0, K, T
+
+def loop_price(theta, S_0, K, t):
+	# C() as it was before C_vec: a ten step trapezoid, one node at a time
+	def P_c1(u):
+		return np.real(np.exp(-1j*u*np.log(K))/(1j*u)*analysis.phi(theta, u - 1j, t, S_0))
+
+	def P_c2(u):
+		return np.real(np.exp(-1j*u*np.log(K))/(1j*u)*analysis.phi(theta, u, t, S_0))
+
+	N = 10
+	tot = 0
+	for k in range(N):
+		i = k + 1
+		if k == 0:
+			k = 0.1
+		fk_1 = 1/np.pi*(P_c1(k) - K*P_c2(k))
+		fk = 1/np.pi*(P_c1(i) - K*P_c2(i))
+		tot += (fk_1 + fk)/2*(i - k)/N
+	return (S_0 - K)/2 + tot
+
+
+@pytest.mark.parametrize('T', [90, None])
+def test_prices_match_the_loop(T):
+	S_0, K, T = dataset(T=T)
+	prices = analysis.C_vec(THETA, S_0, K, T)
+	expected = [loop_price(THETA, s, k, t) for s, k, t in zip(S_0, K, np.broadcast_to(T, len(K)))]
+	np.testing.assert_allclose(prices, expected, rtol=1e-10, atol=1e-10)
+
+def test_residues_match_the_loop():
+	S_0, K, T = dataset()
+	V = analysis.C_vec(THETA*1.1, S_0, K, T)
+	V[0] = -1.0 # negative quotes count as 0
+	res = analysis.r(THETA, S_0, K, V, T)
+	expected = [loop_price(THETA, s, k, T) - max(v, 0) for s, k, v in zip(S_0, K, V)]
+	assert res.shape == (len(K), 1)
+	np.testing.assert_allclose(res.ravel(), expected, rtol=1e-10, atol=1e-10)
+
+@pytest.mark.parametrize('T', [90, None])
+def test_jacobian_matches_finite_differences(T):
+	S_0, K, T = dataset(T=T)
+	quad = quadrature.Quadrature('legendre', n=64, upper=50.0)
+	J = analysis.jac(THETA, S_0, K, T, quad=quad)
+	assert J.shape == (5, len(K))
+	for j in range(5):
+		step = 1e-5*abs(THETA[j])
+		up, down = THETA.copy(), THETA.copy()
+		up[j] += step
+		down[j] -= step
+		column = (analysis.C_vec(up, S_0, K, T, quad=quad) - analysis.C_vec(down, S_0, K, T, quad=quad))/(2*step)
+		np.testing.assert_allclose(J[j], column, rtol=0, atol=1e-7*np.max(np.abs(column)))
+
+def test_no_iterations_returns_the_start():
+	S_0, K, T = dataset()
+	V = analysis.C_vec(THETA, S_0, K, T)
+	result = analysis.HestonCalibrator(S_0, K, V, T, theta0=THETA*1.1, max_iter=0).calibrate()
+	np.testing.assert_array_equal(result.theta, THETA*1.1)
+	assert result.iterations == 0
+	assert result.stop_reason == 'max_iter'
+
+def test_numba_matches_numpy():
+	pytest.importorskip('numba')
+	diff = kernels.compare('numba', 200)
+	assert diff['price'] < 1e-10
+	assert diff['jacobian'] < 1e-10
@@ -0,0 +1,96 @@
+""" CandleStore and sample_calls against a local stand-in for
+	gdax.PublicClient, so nothing touches the network.
+"""
+
+import numpy as np
+import pytest
+from candles import CandleStore, DAY, PAGE
+from sample_calls import make_calls
+
+LISTED = 1500000000//DAY*DAY # the first day the fake exchange has a candle for
+
+
+class FakeClient:
+	""" get_product_historic_rates() over a made up daily history from
+		LISTED up to today, newest first like Coinbase. The candle of today
+		is partial: its close is bumped every time it is fetched.
+	"""
+
+	def __init__(self, today):
+		self.today = today
+		self.calls = []
+		self.fetches_of_today = 0
+
+	def candle(self, t):
+		day = (t - LISTED)//DAY
+		price = 100.0 + day
+		close = price + 0.5
+		if t == self.today:
+			close += self.fetches_of_today
+		return [t, price - 1, price + 1, price, close, 10.0]
+
+	def get_product_historic_rates(self, product_id, start, end, granularity):
+		assert granularity == DAY
+		start, end = int(start.astype('int64')), int(end.astype('int64'))
+		self.calls.append((start, end))
+		times = [t for t in range(max(start, LISTED), min(end, self.today) + 1, DAY)]
+		if self.today in times:
+			self.fetches_of_today += 1
+		return [self.candle(t) for t in reversed(times)]
+
+
+class Offline:
+	def get_product_historic_rates(self, *args, **kwargs):
+		raise AssertionError("the store should not fetch anything")
+
+
+def test_first_update_fetches_the_whole_history_in_pages(tmp_path):
+	today = LISTED + 699*DAY
+	client = FakeClient(today)
+	store = CandleStore(str(tmp_path), client=client, pause=0)
+	assert store.update('BTC-USD', now=today + 3600) == 700
+	# Walks back from today a page at a time until a page comes back short
+	assert len(client.calls) == 3
+	assert client.calls[0] == (today - (PAGE - 1)*DAY, today)
+	candles = store.load('BTC-USD')
+	assert candles[0, 0] == LISTED and candles[-1, 0] == today
+	assert np.all(np.diff(candles[:, 0]) == DAY)
+	# Saved to disk, oldest first
+	reloaded = CandleStore(str(tmp_path)).load('BTC-USD')
+	assert np.array_equal(reloaded, candles)
+
+
+def test_incremental_update_refreshes_the_last_partial_day(tmp_path):
+	today = LISTED + 399*DAY
+	client = FakeClient(today)
+	store = CandleStore(str(tmp_path), client=client, pause=0)
+	store.update('BTC-USD', now=today)
+	partial_close = store.load('BTC-USD')[-1, 4]
+	# Two days later only the days from the last stored one are requested
+	client.today = today + 2*DAY
+	client.calls = []
+	assert store.update('BTC-USD', now=client.today) == 2
+	assert client.calls == [(today, today + 2*DAY)]
+	candles = store.load('BTC-USD')
+	assert len(candles) == 402
+	refreshed = candles[candles[:, 0] == today][0]
+	assert refreshed[4] == client.candle(today)[4] != partial_close
+	# Up to date: one request for the current day, no new candles
+	client.calls = []
+	assert store.update('BTC-USD', now=client.today) == 0
+	assert client.calls == [(client.today, client.today)]
+
+
+def test_make_calls_uses_only_the_store(tmp_path):
+	today = LISTED + 199*DAY
+	CandleStore(str(tmp_path), client=FakeClient(today), pause=0).update('ETH-USD', now=today)
+	store = CandleStore(str(tmp_path), client=Offline())
+	listed = np.datetime64(LISTED, 's').astype('datetime64[D]')
+	dates = listed + np.array([150, 10, 50, 180]) # the last has no candle 30 days on
+	calls = make_calls(store, 'ETH-USD', dates, 30)
+	assert [call[0] for call in calls] == [str(listed + 10), str(listed + 50), str(listed + 150)]
+	for date, S_0, K, value in calls:
+		day = (np.datetime64(date) - listed).astype(int)
+		assert S_0 == pytest.approx(100.0 + day)
+		assert K == pytest.approx(100.0 + day + 30)
+		assert value == pytest.approx(K - S_0)
@@ -0,0 +1,110 @@
+""" fetch.AsyncPublicClient against a local fake of the exchange that
+	answers with rate-limit and server errors.
+"""
+
+import asyncio
+import time
+import pytest
+
+aiohttp = pytest.importorskip('aiohttp')
+from aiohttp import web
+from fetch import AsyncPublicClient, RateLimitError, TokenBucket
+
+
+class FakeExchange:
+	""" Serves /time, failing the first `failures` requests with status
+		(and Retry-After, if given). times records when each request came.
+	"""
+
+	def __init__(self, failures=0, status=429, retry_after=None):
+		self.failures = failures
+		self.status = status
+		self.retry_after = retry_after
+		self.times = []
+
+	async def handle(self, request):
+		self.times.append(time.monotonic())
+		if len(self.times) <= self.failures:
+			headers = {} if self.retry_after is None else {'Retry-After': str(self.retry_after)}
+			return web.json_response({'message': 'slow down'}, status=self.status, headers=headers)
+		return web.json_response({'iso': '2018-06-12T00:00:00Z', 'epoch': 1528761600.0})
+
+	async def run(self, test):
+		# Serve on a free local port for the duration of test(base_url)
+		app = web.Application()
+		app.router.add_get('/time', self.handle)
+		runner = web.AppRunner(app)
+		await runner.setup()
+		site = web.TCPSite(runner, '127.0.0.1', 0)
+		await site.start()
+		port = runner.addresses[0][1]
+		try:
+			return await test('http://127.0.0.1:%s' % port)
+		finally:
+			await runner.cleanup()
+
+
+def serve(exchange, **kwargs):
+	# Fetch /time once from the fake exchange with a client built from kwargs
+	async def test(url):
+		async with AsyncPublicClient(url, **kwargs) as client:
+			return await client.get_time(), client.requests
+	return asyncio.run(exchange.run(test))
+
+
+def test_retry_after_is_honoured():
+	exchange = FakeExchange(failures=2, status=429, retry_after=0.2)
+	start = time.monotonic()
+	result, requests = serve(exchange, backoff=30)
+	assert result['epoch'] == 1528761600.0
+	assert requests == 3
+	# The server's Retry-After replaces the (much longer) backoff
+	gaps = [b - a for a, b in zip(exchange.times, exchange.times[1:])]
+	assert all(0.18 <= gap < 1.0 for gap in gaps)
+	assert time.monotonic() - start < 5
+
+
+def test_server_errors_back_off_exponentially():
+	exchange = FakeExchange(failures=3, status=503)
+	result, requests = serve(exchange, backoff=0.05)
+	assert requests == 4
+	# backoff*2**attempt, with up to 50% jitter
+	gaps = [b - a for a, b in zip(exchange.times, exchange.times[1:])]
+	for attempt, gap in enumerate(gaps):
+		assert 0.05*2**attempt*0.95 <= gap <= 0.05*2**attempt*1.5 + 0.1
+	assert gaps[0] < gaps[1] < gaps[2]
+
+
+def test_gives_up_after_the_retries():
+	exchange = FakeExchange(failures=100, status=429, retry_after=0)
+	with pytest.raises(RateLimitError, match="HTTP 429"):
+		serve(exchange, retries=2)
+	assert len(exchange.times) == 3
+
+
+def test_requests_are_paced_by_the_token_bucket():
+	exchange = FakeExchange()
+	rate, burst, n = 20.0, 2, 8
+
+	async def test(url):
+		async with AsyncPublicClient(url, rate=rate, burst=burst) as client:
+			return await client.gather(client.get_time() for i in range(n))
+
+	start = time.monotonic()
+	results = asyncio.run(exchange.run(test))
+	assert len(results) == n
+	times = sorted(t - start for t in exchange.times)
+	# A burst at once, then one request every 1/rate seconds
+	assert times[burst - 1] < 0.5/rate + 0.1
+	assert times[-1] >= (n - burst)/rate*0.9
+
+
+def test_token_bucket_refills_at_its_rate():
+	async def acquire(bucket, n):
+		start = time.monotonic()
+		for i in range(n):
+			await bucket.acquire()
+		return time.monotonic() - start
+
+	assert asyncio.run(acquire(TokenBucket(rate=50.0, capacity=5), 5)) < 0.05
+	assert asyncio.run(acquire(TokenBucket(rate=50.0, capacity=5), 15)) >= 10/50.0*0.9
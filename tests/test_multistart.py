@@ -0,0 +1,23 @@
+""" Multi-start calibration on a synthetic dataset whose starts fall into
+	different local minima.
+"""
+
+import numpy as np
+import analysis
+import benchmark
+import multistart
+
+
+def test_as_good_as_the_best_start_alone():
+	S_0, K, V, T = benchmark.synthetic(200)
+	quad = benchmark.synthetic_quad()
+	thetas = multistart.starting_thetas(8, seed=0)
+	alone = [analysis.HestonCalibrator(S_0, K, V, T, theta0=theta, quad=quad, max_iter=200).calibrate()
+		for theta in thetas]
+	norms = np.array([result.residual_norm for result in alone])
+	# Some starts stall far from the fit, so the pruning is put to the test
+	assert norms.max() > 1e3*norms.min()
+	fit = multistart.calibrate(S_0, K, V, T, thetas=thetas, max_iter=200, workers=2, quad=quad)
+	# Both stop once the residual norm is below the objective threshold
+	assert fit.best.residual_norm <= max(norms.min(), 1e-6)
+	assert fit.starts == 8